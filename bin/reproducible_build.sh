@@ -56,19 +56,6 @@ create_results_dirs() {
 	mkdir -vp $DEBIAN_BASE/buildinfo/${SUITE}/${ARCH}
 }
 
-handle_race_condition() {
-	local RESULT=$(query_db "SELECT job FROM schedule WHERE package_id='$SRCPKGID'")
-	local msg="Package ${SRCPACKAGE} (id=$SRCPKGID) in ${SUITE} on ${ARCH} is probably already building at $RESULT, while this is $BUILD_URL.\n"
-	log_warning "$msg"
-	printf "$(date -u) - $msg" >> /var/log/jenkins/reproducible-race-conditions.log
-	log_warning "Terminating this build quickly and nicely..."
-	if [ $SAVE_ARTIFACTS -eq 1 ] ; then
-		SAVE_ARTIFACTS=0
-		if [ ! -z "$NOTIFY" ] ; then NOTIFY="failure" ; fi
-	fi
-	exit 0
-}
-
 save_artifacts() {
 		local random=$(head /dev/urandom | tr -cd '[:alnum:]'| head -c5)
 		local ARTIFACTS="artifacts/r00t-me/${SRCPACKAGE}_${SUITE}_${ARCH}_tmp-${random}"
@@ -116,7 +103,7 @@ cleanup_all() {
 	if [ "$MODE" = "master" ] ; then
 		# XXX quite ugly: this is just needed to update the sizes of the
 		# compressed files in the html. It's cheap and quite safe so, *shrugs*...
-		gen_package_html $SRCPACKAGE
+		gen_package_html $SRCPACKAGE || true
 		cd
 		rm -r $TMPDIR || true
 	fi
@@ -162,7 +149,12 @@ update_db_and_html() {
 	# unmark build since it's properly finished
 	query_db "DELETE FROM schedule WHERE package_id='$SRCPKGID';" || \
 	query_db "DELETE FROM schedule WHERE package_id='$SRCPKGID';"
-	gen_package_html $SRCPACKAGE
+	if ! gen_package_html $SRCPACKAGE ; then
+		# record the change, so reproducible_html_packages.py --incremental
+		# catches up with the pages that could not be generated
+		query_db "INSERT INTO rb_pkg_journal (name, suite, architecture, date_added) VALUES ('$SRCPACKAGE', '$SUITE', '$ARCH', '$DATE')" || \
+		query_db "INSERT INTO rb_pkg_journal (name, suite, architecture, date_added) VALUES ('$SRCPACKAGE', '$SUITE', '$ARCH', '$DATE')"
+	fi
 	echo
 	echo "$(date -u) - successfully updated the database and updated $DEBIAN_URL/rb-pkg/${SUITE}/${ARCH}/$SRCPACKAGE.html"
 	echo
@@ -452,25 +444,6 @@ call_diffoscope_on_changes_files() {
 }
 
 choose_package() {
-	local RESULT=$(query_db "
-		SELECT s.suite, s.id, s.name, s.version, sch.save_artifacts, sch.notify, s.notify_maintainer, sch.message, sch.date_scheduled
-		FROM schedule AS sch JOIN sources AS s ON sch.package_id=s.id
-		WHERE sch.date_build_started is NULL
-		AND s.architecture='$ARCH'
-		ORDER BY date_scheduled LIMIT 5"|sort -R|head -1)
-	if [ -z "$RESULT" ] ; then
-		echo "No packages scheduled, sleeping 30m."
-		sleep 30m
-		exit 0
-	fi
-	SUITE=$(echo $RESULT|cut -d "|" -f1)
-	SRCPKGID=$(echo $RESULT|cut -d "|" -f2)
-	SRCPACKAGE=$(echo $RESULT|cut -d "|" -f3)
-	VERSION=$(echo $RESULT|cut -d "|" -f4)
-	SAVE_ARTIFACTS=$(echo $RESULT|cut -d "|" -f5)
-	NOTIFY=$(echo $RESULT|cut -d "|" -f6)
-	NOTIFY_MAINTAINER=$(echo $RESULT|cut -d "|" -f7)
-	SCHEDULE_MESSAGE=$(echo $RESULT|cut -d "|" -f8)
 	# remove previous build attempts which didnt finish correctly:
 	JOB_PREFIX="${JOB_NAME#reproducible_builder_}/"
 	BAD_BUILDS=$(mktemp --tmpdir=$TMPDIR)
@@ -483,22 +456,23 @@ choose_package() {
 		query_db "UPDATE schedule SET date_build_started = NULL, job = NULL WHERE job LIKE '${JOB_PREFIX}%'"
 	fi
 	rm -f $BAD_BUILDS
-	# mark build attempt, first test if none else marked a build attempt recently
-	echo "ok, let's check if $SRCPACKAGE is building anywhere yet…"
-	RESULT=$(query_db "SELECT date_build_started FROM schedule WHERE package_id='$SRCPKGID'")
+	# atomically mark our build attempt on the package scheduled the earliest,
+	# skipping those other workers are claiming at the same time
+	local RESULT=$(/srv/jenkins/bin/reproducible_claim_package.py --arch "$ARCH" --job "$JOB" --date "$DATE")
 	if [ -z "$RESULT" ] ; then
-		echo "ok, $SRCPACKAGE is not building anywhere…"
-		# try to update the schedule with our build attempt, then check no else did it, if so, abort
-		query_db "UPDATE schedule SET date_build_started='$DATE', job='$JOB' WHERE package_id='$SRCPKGID' AND date_build_started IS NULL"
-		RESULT=$(query_db "SELECT date_build_started FROM schedule WHERE package_id='$SRCPKGID' AND date_build_started='$DATE' AND job='$JOB'")
-		if [ -z "$RESULT" ] ; then
-			echo "hm, seems $SRCPACKAGE is building somewhere… failed to update the schedule table with our build ($SRCPKGID, $DATE, $JOB)."
-			handle_race_condition
-		fi
-	else
-		echo "hm, seems $SRCPACKAGE is building somewhere… schedule table now listed it as building somewhere else."
-		handle_race_condition
+		echo "No packages scheduled, sleeping 30m."
+		sleep 30m
+		exit 0
 	fi
+	SUITE=$(echo $RESULT|cut -d "|" -f1)
+	SRCPKGID=$(echo $RESULT|cut -d "|" -f2)
+	SRCPACKAGE=$(echo $RESULT|cut -d "|" -f3)
+	VERSION=$(echo $RESULT|cut -d "|" -f4)
+	SAVE_ARTIFACTS=$(echo $RESULT|cut -d "|" -f5)
+	NOTIFY=$(echo $RESULT|cut -d "|" -f6)
+	NOTIFY_MAINTAINER=$(echo $RESULT|cut -d "|" -f7)
+	SCHEDULE_MESSAGE=$(echo $RESULT|cut -d "|" -f8)
+	echo "ok, $SRCPACKAGE ($SRCPKGID) is now marked as building here ($DATE, $JOB)."
 	local ANNOUNCE=""
 	if [ $SAVE_ARTIFACTS -eq 1 ] ; then
 		ANNOUNCE="Artifacts will be preserved."
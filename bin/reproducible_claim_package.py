@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Depends: python3
+#
+# Claim the next scheduled package for a build worker, see
+# claim_scheduled_package() in reproducible_common.py.
+# The claimed package is printed in the same "|"-separated format as
+# `psql -t -A`, nothing is printed if no package is scheduled.
+
+from reproducible_common import *
+
+
+if __name__ == '__main__':
+    local_parser = argparse.ArgumentParser(
+        description='Claim the next package scheduled on an architecture')
+    local_parser.add_argument('--arch', required=True,
+        help='architecture to claim a package for')
+    local_parser.add_argument('--job', required=True,
+        help='name of the job that is going to build the package')
+    local_parser.add_argument('--date', required=True,
+        help='build start date, "YYYY-MM-DD HH:MM"')
+    local_args = local_parser.parse_known_args(unknown_args)[0]
+    claimed = claim_scheduled_package(local_args.arch, local_args.job,
+                                      local_args.date)
+    if claimed:
+        print('|'.join('' if x is None else str(x) for x in claimed))
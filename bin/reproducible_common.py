@@ -15,7 +15,9 @@ import re
 import sys
 import csv
 import json
+import time
 import errno
+import fcntl
 import atexit
 import hashlib
 import logging
@@ -25,6 +27,9 @@ import psycopg2
 import html as HTML
 from string import Template
 from traceback import print_exception
+from collections import Counter, namedtuple
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import call, check_call
 from tempfile import NamedTemporaryFile
 from datetime import datetime, timedelta
@@ -51,10 +56,19 @@ BASE = '/var/lib/jenkins/userContent/reproducible'
 DEBIAN_BASE = '/var/lib/jenkins/userContent/reproducible/debian'
 TEMPLATE_PATH = '/srv/jenkins/mustache-templates/reproducible'
 PKGSET_DEF_PATH = '/srv/reproducible-results'
+PAGE_HASHES_PATH = '/srv/reproducible-results/page-hashes'
+SOURCES_CACHE_PATH = '/srv/reproducible-results/sources-cache'
+PBUILDER_DEP_FAIL_CACHE = '/srv/reproducible-results/pbuilder-dep-fail-cache.json'
+GRAPH_CACHE_PATH = '/srv/reproducible-results/graph-cache'
+REPRODUCIBLE_JSON_STATE = '/srv/reproducible-results/reproducible-json-state.tsv'
+RESULTS_SNAPSHOT_PATH = '/srv/reproducible-results/results-snapshot'
 TEMP_PATH="/tmp/reproducible"
 
 REPRODUCIBLE_JSON = BASE + '/reproducible.json'
+REPRODUCIBLE_COMPACT_JSON = BASE + '/reproducible-compact.json'
 REPRODUCIBLE_TRACKER_JSON = BASE + '/reproducible-tracker.json'
+REPRODUCIBLE_JSON_MANIFEST = BASE + '/reproducible-manifest.json'
+REPRODUCIBLE_JSON_DELTAS = BASE + '/reproducible-deltas'
 REPRODUCIBLE_STYLES = BASE +'/static/style.css'
 
 DEBIAN_URI = '/debian'
@@ -103,6 +117,14 @@ parser.add_argument("--skip-database-connection", action="store_true",
                    help="skip connecting to database")
 parser.add_argument("--ignore-missing-files", action="store_true",
                     help="useful for local testing, where you don't have all the build logs, etc..")
+parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                    help="use N worker processes where supported (0 means one per CPU)")
+parser.add_argument("--mirror", default="http://deb.debian.org/debian",
+                    help="debian mirror to get the Sources from, either an URL or a local directory")
+parser.add_argument("--profile-sql", nargs="?", const=True, default=False,
+                    metavar="FILE",
+                    help="profile the SQL statements and write a report to FILE "
+                         "(default: <script>.sql-profile.json in the current directory)")
 args, unknown_args = parser.parse_known_args()
 log_level = logging.INFO
 if args.debug or DEBUG:
@@ -154,6 +176,8 @@ log.debug("DEBIAN_URL:\t" + DEBIAN_URL)
 
 if args.ignore_missing_files:
     log.warning("Missing files will be ignored!")
+if args.jobs < 1:
+    args.jobs = os.cpu_count() or 1
 
 tab = '  '
 
@@ -164,19 +188,46 @@ with open(REPRODUCIBLE_STYLES, 'rb') as f:
 REPRODUCIBLE_STYLE_SHA1 = hasher.hexdigest()
 
 # Templates used for creating package pages
+# All the scripts share this renderer and get their templates through
+# get_template(), so that every template is read and parsed only once.
 renderer = pystache.Renderer()
-status_icon_link_template = renderer.load_template(
-    TEMPLATE_PATH + '/status_icon_link')
-default_page_footer_template = renderer.load_template(
-    TEMPLATE_PATH + '/default_page_footer')
-pkg_legend_template = renderer.load_template(
-    TEMPLATE_PATH + '/pkg_symbol_legend')
-project_links_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'project_links'))
-main_navigation_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'main_navigation'))
-basic_page_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'basic_page'))
+_templates = {}         # name → parsed template
+_static_fragments = {}  # name → output of a template without context
+
+
+def get_template(name):
+    """
+    Return the parsed template `name` from TEMPLATE_PATH, loading it only
+    the first time.
+    """
+    try:
+        return _templates[name]
+    except KeyError:
+        pass
+    template = pystache.parse(renderer.load_template(
+        os.path.join(TEMPLATE_PATH, name)))
+    _templates[name] = template
+    return template
+
+
+def render_static(name):
+    """
+    Return the output of the template `name` rendered without any context,
+    rendering it only the first time.
+    """
+    try:
+        return _static_fragments[name]
+    except KeyError:
+        pass
+    html = renderer.render(get_template(name), {})
+    _static_fragments[name] = html
+    return html
+
+
+status_icon_link_template = get_template('status_icon_link')
+default_page_footer_template = get_template('default_page_footer')
+main_navigation_template = get_template('main_navigation')
+basic_page_template = get_template('basic_page')
 
 try:
     JOB_URL = os.environ['JOB_URL']
@@ -265,14 +316,29 @@ def convert_into_hms_string(duration):
     return duration
 
 
+# The navigation only depends on a few arguments and the same few dozen
+# combinations are asked for over and over, so both the suite/arch contexts
+# and the rendered navigations are memoized, in bounded caches.
+NAVIGATION_CACHE_SIZE = 512
+
+
 def gen_suite_arch_nav_context(suite, arch, suite_arch_nav_template=None,
                                ignore_experimental=False, no_suite=None,
                                no_arch=None):
+    return _gen_suite_arch_nav_context(suite, arch, suite_arch_nav_template,
+                                       bool(ignore_experimental),
+                                       bool(no_suite), bool(no_arch))
+
+
+@lru_cache(maxsize=NAVIGATION_CACHE_SIZE)
+def _gen_suite_arch_nav_context(suite, arch, suite_arch_nav_template,
+                                ignore_experimental, no_suite, no_arch):
     # if a template is not passed in to navigate between suite and archs the
     # current page, we use the "default" suite/arch summary view.
     default_nav_template = '/debian/{{suite}}/index_suite_{{arch}}_stats.html'
     if not suite_arch_nav_template:
         suite_arch_nav_template = default_nav_template
+    suite_arch_nav_template = pystache.parse(suite_arch_nav_template)
 
     suite_list = []
     if not no_suite:
@@ -304,12 +370,22 @@ def create_main_navigation(suite=defaultsuite, arch=defaultarch,
                            displayed_page=None, suite_arch_nav_template=None,
                            ignore_experimental=False, no_suite=None,
                            no_arch=None):
+    return _create_main_navigation(suite, arch, displayed_page,
+                                   suite_arch_nav_template,
+                                   bool(ignore_experimental), bool(no_suite),
+                                   bool(no_arch))
+
+
+@lru_cache(maxsize=NAVIGATION_CACHE_SIZE)
+def _create_main_navigation(suite, arch, displayed_page,
+                            suite_arch_nav_template, ignore_experimental,
+                            no_suite, no_arch):
     suite_list, arch_list = gen_suite_arch_nav_context(suite, arch,
         suite_arch_nav_template, ignore_experimental, no_suite, no_arch)
     context = {
         'suite': suite,
         'arch': arch,
-        'project_links_html': renderer.render(project_links_template),
+        'project_links_html': render_static('project_links'),
         'suite_nav': {
             'suite_list': suite_list
         } if len(suite_list) else '',
@@ -329,16 +405,109 @@ def create_main_navigation(suite=defaultsuite, arch=defaultarch,
     return renderer.render(main_navigation_template, context)
 
 
+@atexit.register
+def print_navigation_cache_stats():
+    info = _create_main_navigation.cache_info()
+    if info.hits or info.misses:
+        log.debug('Main navigation cache: %s hits, %s misses, %s cached.',
+                  info.hits, info.misses, info.currsize)
+
+
+# write_html_page() doesn't rewrite pages whose content didn't change.
+# To know that, the sha1 of every written page (computed with a placeholder
+# instead of the date in the footer) is kept in an index file per directory,
+# together with the size and mtime the page had once written.
+FOOTER_DATE_PLACEHOLDER = '@@FOOTER_DATE@@'
+html_pages_stats = Counter()
+_page_hashes = {}        # directory → {filename: [sha1, size, mtime_ns]}
+_page_hashes_dirty = {}  # directory → set of filenames updated in this run
+
+
+def _page_hashes_index(directory):
+    return os.path.join(PAGE_HASHES_PATH, os.path.abspath(directory).strip('/')
+                        .replace('/', '_') + '.json')
+
+
+def _load_page_hashes(directory):
+    try:
+        return _page_hashes[directory]
+    except KeyError:
+        pass
+    try:
+        with open(_page_hashes_index(directory)) as fd:
+            hashes = json.load(fd)
+    except (OSError, ValueError):
+        hashes = {}
+    _page_hashes[directory] = hashes
+    return hashes
+
+
+def _page_unchanged(destfile, sha1):
+    directory, filename = os.path.split(destfile)
+    try:
+        known = _load_page_hashes(directory)[filename]
+        stat = os.stat(destfile)
+    except (KeyError, OSError):
+        return False
+    return known == [sha1, stat.st_size, stat.st_mtime_ns]
+
+
+def _remember_page_hash(destfile, sha1):
+    directory, filename = os.path.split(destfile)
+    stat = os.stat(destfile)
+    _load_page_hashes(directory)[filename] = \
+        [sha1, stat.st_size, stat.st_mtime_ns]
+    _page_hashes_dirty.setdefault(directory, set()).add(filename)
+
+
+def save_page_hashes():
+    """
+    Save the hashes of the pages written by write_html_page(). The index files
+    are re-read first, so that the entries saved in the meantime by other
+    processes are kept; each index is locked while it's merged, as the pool
+    workers and the builds save theirs concurrently.
+    """
+    if not _page_hashes_dirty:
+        return
+    try:
+        os.makedirs(PAGE_HASHES_PATH, exist_ok=True)
+        for directory, filenames in _page_hashes_dirty.items():
+            index = _page_hashes_index(directory)
+            with open(index + '.lock', 'w') as lockfd:
+                fcntl.flock(lockfd, fcntl.LOCK_EX)
+                try:
+                    with open(index) as fd:
+                        hashes = json.load(fd)
+                except (OSError, ValueError):
+                    hashes = {}
+                for filename in filenames:
+                    hashes[filename] = _page_hashes[directory][filename]
+                with NamedTemporaryFile(mode='w', dir=PAGE_HASHES_PATH,
+                                        delete=False) as fd:
+                    json.dump(hashes, fd)
+                os.rename(fd.name, index)
+    except OSError as e:
+        log.warning('Could not save the hashes of the written pages: %s', e)
+    _page_hashes_dirty.clear()
+
+
+@atexit.register
+def print_html_pages_stats():
+    save_page_hashes()
+    if html_pages_stats:
+        log.info('HTML pages written: %s, skipped as unchanged: %s',
+                 html_pages_stats['written'], html_pages_stats['skipped'])
+
+
 def write_html_page(title, body, destfile, no_header=False, style_note=False,
                     noendpage=False, refresh_every=None, displayed_page=None,
                     left_nav_html=None):
     meta_refresh_html = '<meta http-equiv="refresh" content="%d"></meta>' % \
         refresh_every if refresh_every is not None else ''
     if style_note:
-        body += renderer.render(pkg_legend_template, {})
+        body += render_static('pkg_symbol_legend')
     if not noendpage:
-        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
-        body += create_default_page_footer(now)
+        body += create_default_page_footer(FOOTER_DATE_PLACEHOLDER)
     context = {
         'page_title': title,
         'meta_refresh_html': meta_refresh_html,
@@ -348,6 +517,14 @@ def write_html_page(title, body, destfile, no_header=False, style_note=False,
         'style_dot_css_sha1sum': REPRODUCIBLE_STYLE_SHA1,
     }
     html = renderer.render(basic_page_template, context)
+    sha1 = hashlib.sha1(html.encode('UTF-8')).hexdigest()
+    if not noendpage:
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
+        html = html.replace(FOOTER_DATE_PLACEHOLDER, now)
+    if _page_unchanged(destfile, sha1):
+        log.debug("Skipping " + destfile + ", it didn't change")
+        html_pages_stats['skipped'] += 1
+        return
 
     try:
         os.makedirs(destfile.rsplit('/', 1)[0], exist_ok=True)
@@ -357,6 +534,80 @@ def write_html_page(title, body, destfile, no_header=False, style_note=False,
     log.debug("Writing " + destfile)
     with open(destfile, 'w', encoding='UTF-8') as fd:
         fd.write(html)
+    html_pages_stats['written'] += 1
+    _remember_page_hash(destfile, sha1)
+
+
+# how many directories scan_trees() lists in parallel
+SCAN_THREADS = 16
+
+ScanEntry = namedtuple('ScanEntry', ['kind', 'suite', 'arch', 'subdir',
+                                     'name', 'path', 'size', 'mtime'])
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as it:
+            return list(it)
+    except FileNotFoundError:
+        return []
+
+
+def _scan_suite_arch(kind, suite, arch, path, stat):
+    entries = []
+    dirs = [(path, '')]
+    while dirs:
+        directory, subdir = dirs.pop()
+        for entry in _scandir(directory):
+            if entry.is_dir():
+                dirs.append((entry.path, os.path.join(subdir, entry.name)))
+                continue
+            if stat:
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:  # gone in the meantime
+                    continue
+                size, mtime = st.st_size, st.st_mtime
+            else:
+                size = mtime = None
+            entries.append(ScanEntry(kind, suite, arch, subdir, entry.name,
+                                     entry.path, size, mtime))
+    return entries
+
+
+def scan_trees(trees, suites=None, archs=None, stat=True):
+    """
+    List all the files of some trees laid out as <tree>/<suite>/<arch>/,
+    with one task per suite/arch/tree run in a pool of SCAN_THREADS threads,
+    so that the time taken is bound by the slowest directory.
+
+    Arguments:
+        trees: a dict kind → directory
+        suites, archs: only scan these suites/archs, by default all the
+            directories found are scanned
+        stat: if False don't stat() the files, their size and mtime are None
+
+    Returns a dict kind → list of ScanEntry, the files found below the arch
+    directories have their relative directory in `subdir`.
+    """
+    tasks = []
+    for kind, directory in sorted(trees.items()):
+        for suite in _scandir(directory):
+            if not suite.is_dir() or (suites and suite.name not in suites):
+                continue
+            for arch in _scandir(suite.path):
+                if not arch.is_dir() or (archs and arch.name not in archs):
+                    continue
+                tasks.append((kind, suite.name, arch.name, arch.path, stat))
+    entries = {kind: [] for kind in trees}
+    start = datetime.now()
+    with ThreadPoolExecutor(max_workers=SCAN_THREADS) as pool:
+        for result in pool.map(lambda x: _scan_suite_arch(*x), tasks):
+            for entry in result:
+                entries[entry.kind].append(entry)
+    log.info('Scanned %s directories, %s files found in %s', len(tasks),
+             sum(len(x) for x in entries.values()), datetime.now() - start)
+    return entries
 
 
 def db_table(table_name):
@@ -374,9 +625,43 @@ def db_table(table_name):
         raise
 
 
-def query_db(query):
+def reconnect_db():
+    """
+    Open a new connection to the database. This needs to be called by worker
+    processes, as a database connection can't be shared with the parent.
+    """
+    global DB_ENGINE, DB_METADATA, conn_db
+    if args.skip_database_connection:
+        return
+    DB_ENGINE = create_engine("postgresql:///%s" % PGDATABASE)
+    DB_METADATA = MetaData(DB_ENGINE)
+    conn_db = DB_ENGINE.connect()
+    _prepared.clear()
+
+
+def init_worker():
+    """
+    Initializer for multiprocessing pools: reconnect to the database and
+    tag the log lines with the name of the worker.
+    """
+    reconnect_db()
+    # the worker got a copy of the parent's profile and counters when forked,
+    # start anew so that only its own statements are passed back to the parent
+    sql_profile.clear()
+    statement_counters.clear()
+    sh.setFormatter(logging.Formatter(
+        '[%(asctime)s] %(processName)s %(levelname)s: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'))
+
+
+def query_db(query, params=None):
     """Excutes a raw SQL query. Return depends on query type.
 
+    Arguments:
+        query: a string or a SQLAlchemy query
+        params: optional dict of values to bind to the :name placeholders
+            of a string query
+
     Returns:
         select:
             list of tuples
@@ -385,18 +670,301 @@ def query_db(query):
         insert:
             None
     """
+    if args.profile_sql:
+        start = time.time()
     try:
-        result = conn_db.execute(query)
+        if params is None:
+            result = conn_db.execute(query)
+        else:
+            if isinstance(query, str):
+                query = sql.text(query)
+            result = conn_db.execute(query, params)
     except OperationalError as ex:
-        print_critical_message('Error executing this query:\n' + query)
+        print_critical_message('Error executing this query:\n' + str(query))
         raise
 
     if result.returns_rows:
-        return result.fetchall()
+        ret = result.fetchall()
+        rows = len(ret)
     elif result.supports_sane_rowcount() and result.rowcount > -1:
-        return result.rowcount
+        ret = rows = result.rowcount
     else:
-        return None
+        ret, rows = None, 0
+    if args.profile_sql:
+        profile_statement(query, time.time() - start, rows)
+    return ret
+
+
+# normalized statement → [count, total time, max time, rows]
+sql_profile = {}
+_sql_literals = re.compile(r"'(?:[^']|'')*'|(?<!\$)\b\d+(?:\.\d+)?\b")
+
+
+def profile_statement(query, elapsed, rows):
+    """
+    Record an executed statement for --profile-sql. The statements are
+    normalized by replacing the literals with '?', so that the same query
+    run for different packages is only accounted once.
+    """
+    statement = _sql_literals.sub('?', ' '.join(str(query).split()))
+    stats = sql_profile.setdefault(statement, [0, 0.0, 0.0, 0])
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+    stats[3] += rows
+
+
+def merge_sql_profile(profile):
+    """
+    Add to sql_profile the statements profiled in another process, e.g. a
+    worker of a multiprocessing pool.
+    """
+    for statement, (count, total, maximum, rows) in profile.items():
+        stats = sql_profile.setdefault(statement, [0, 0.0, 0.0, 0])
+        stats[0] += count
+        stats[1] += total
+        stats[2] = max(stats[2], maximum)
+        stats[3] += rows
+
+
+@atexit.register
+def print_sql_profile(top=25):
+    if not args.profile_sql or not sql_profile:
+        return
+    profile = sorted(sql_profile.items(), key=lambda x: x[1][1], reverse=True)
+    log.info('SQL profile, top %s statements by total time:', top)
+    log.info('%7s %10s %9s %9s  %s', 'count', 'total', 'max', 'rows',
+             'statement')
+    for statement, (count, total, maximum, rows) in profile[:top]:
+        log.info('%7d %9.3fs %8.3fs %9d  %s', count, total, maximum, rows,
+                 statement[:150])
+    log.info('%d statements run, %d distinct, %.3fs in total.',
+             sum(x[1][0] for x in profile), len(profile),
+             sum(x[1][1] for x in profile))
+    if args.profile_sql is True:
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        destfile = script + '.sql-profile.json'
+    else:
+        destfile = args.profile_sql
+    try:
+        with open(destfile, 'w') as fd:
+            json.dump([{'statement': statement, 'count': count,
+                        'total': total, 'max': maximum, 'rows': rows}
+                       for statement, (count, total, maximum, rows)
+                       in profile], fd, indent=2)
+    except OSError as e:
+        log.warning('Could not write the SQL profile to %s: %s', destfile, e)
+    else:
+        log.info('SQL profile written to %s', os.path.abspath(destfile))
+
+
+# Named statements for the hot per-package lookups. They are prepared server
+# side the first time they are used on a connection, so repeating them
+# doesn't cost a parse and plan every time. Use $1, $2, ... as placeholders.
+PREPARED_STATEMENTS = {
+    'result_version': """
+        SELECT r.version
+        FROM results AS r JOIN sources AS s ON r.package_id=s.id
+        WHERE s.name=$1 AND s.suite=$2 AND s.architecture=$3""",
+    'build_status': """
+        SELECT r.status, r.version, r.build_date
+        FROM results AS r JOIN sources AS s ON r.package_id=s.id
+        WHERE s.name=$1 AND s.suite=$2 AND s.architecture=$3""",
+    'source_version': """
+        SELECT version FROM sources
+        WHERE name=$1 AND suite=$2 AND architecture=$3""",
+    'package_notes': """
+        SELECT n.issues, n.bugs, n.comments
+        FROM sources AS s JOIN notes AS n ON s.id=n.package_id
+        WHERE s.name=$1 AND s.suite=$2 AND s.architecture=$3""",
+    'issue': """
+        SELECT url, description FROM issues WHERE name=$1""",
+    'notify_maintainer': """
+        SELECT notify_maintainer FROM sources WHERE name=$1""",
+    'package_history': """
+        SELECT id, version, suite, architecture, status, build_date,
+            build_duration, node1, node2, job, schedule_message
+        FROM stats_build WHERE name=$1 ORDER BY build_date DESC""",
+}
+# statements already prepared on the current connection
+_prepared = set()
+# how many times every prepared statement has been executed
+statement_counters = Counter()
+
+
+def query_prepared(name, *params):
+    """
+    Execute the statement `name` from PREPARED_STATEMENTS with the given
+    parameters, preparing it first if needed.
+    Returns a list of tuples.
+    """
+    cursor = conn_db.connection.cursor()
+    if name not in _prepared:
+        log.debug('Preparing the %s statement', name)
+        cursor.execute('PREPARE {} AS {}'.format(
+            name, PREPARED_STATEMENTS[name]))
+        _prepared.add(name)
+    statement_counters[name] += 1
+    if args.profile_sql:
+        start = time.time()
+    cursor.execute('EXECUTE {} ({})'.format(
+        name, ', '.join(['%s'] * len(params))), params)
+    result = cursor.fetchall()
+    if args.profile_sql:
+        profile_statement('EXECUTE ' + name + ': ' + PREPARED_STATEMENTS[name],
+                          time.time() - start, len(result))
+    return result
+
+
+@atexit.register
+def print_statement_counters():
+    if statement_counters:
+        log.info('Prepared statements executed: %s', ', '.join(
+            '%s: %s' % x for x in statement_counters.most_common()))
+
+
+def journal_packages(packages):
+    """
+    Record in the rb_pkg_journal table that the rb-pkg pages of some packages
+    need to be regenerated, reproducible_html_packages.py --incremental will
+    then take care of them.
+    `packages` is a list of (name, suite, architecture) tuples.
+    """
+    if not packages:
+        return
+    date = datetime.now().strftime('%Y-%m-%d %H:%M')
+    rows = [{'name': name, 'suite': suite, 'architecture': arch,
+             'date_added': date} for name, suite, arch in packages]
+    conn_db.execute(db_table('rb_pkg_journal').insert(), rows)
+    log.debug('Added %s packages to the rb-pkg journal', len(rows))
+
+
+def journal_package_ids(package_ids):
+    """
+    Like journal_packages(), but taking a list of ids from the sources table.
+    """
+    if not package_ids:
+        return
+    sources = db_table('sources')
+    query = sql.select(
+        [sources.c.name, sources.c.suite, sources.c.architecture]
+    ).where(sources.c.id.in_(list(package_ids)))
+    journal_packages(query_db(query))
+
+
+def claim_scheduled_package(arch, job, date):
+    """
+    Atomically mark the next package scheduled on `arch` (the one scheduled
+    the earliest) as being built by `job`. Rows already locked by other
+    workers claiming at the same time are skipped, so two workers can never
+    get the same package.
+    Returns (suite, id, name, version, save_artifacts, notify,
+    notify_maintainer, message, date_scheduled), or None if there is nothing
+    to build.
+    """
+    query = sql.text("""
+        WITH claimed AS (
+            UPDATE schedule SET date_build_started=:date, job=:job
+            WHERE id = (
+                SELECT sch.id
+                FROM schedule AS sch JOIN sources AS s ON sch.package_id=s.id
+                WHERE sch.date_build_started IS NULL
+                AND s.architecture=:arch
+                ORDER BY sch.date_scheduled, sch.id
+                LIMIT 1
+                FOR UPDATE OF sch SKIP LOCKED)
+            RETURNING package_id, save_artifacts, notify, message,
+                      date_scheduled)
+        SELECT s.suite, s.id, s.name, s.version, c.save_artifacts, c.notify,
+               s.notify_maintainer, c.message, c.date_scheduled
+        FROM claimed AS c JOIN sources AS s ON s.id=c.package_id
+        """).bindparams(arch=arch, job=job, date=date)
+    result = query_db(query.execution_options(autocommit=True))
+    return result[0] if result else None
+
+
+class ResultsSnapshot:
+    """
+    Read-only, memory-mapped, columnar snapshot of the results, as written
+    by reproducible_results_snapshot.py.
+    Every column is a numpy array with a row for every package (ie. every
+    line of the sources table); string columns are dictionary encoded: the
+    array holds int32 codes (-1 for NULL) into dictionary(column).
+    """
+    def __init__(self, path):
+        import numpy
+        self.numpy = numpy
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fd:
+            self.meta = json.load(fd)
+        self.columns = {}
+        self.dictionaries = {}
+        for column, kind in self.meta['columns'].items():
+            self.columns[column] = numpy.load(
+                os.path.join(path, column + '.npy'), mmap_mode='r')
+            if kind == 'dict':
+                self.dictionaries[column] = numpy.load(
+                    os.path.join(path, column + '.dict.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def dictionary(self, column):
+        return self.dictionaries[column]
+
+    def code(self, column, value):
+        """
+        Return the code of `value` in a dictionary encoded column, or -1.
+        """
+        dictionary = self.dictionaries[column]
+        pos = self.numpy.searchsorted(dictionary, value)
+        if pos < len(dictionary) and dictionary[pos] == value:
+            return int(pos)
+        return -1
+
+    def decode(self, column, rows=None):
+        """
+        Return the values of a column (only of `rows`, a mask or an index
+        array, if given), decoding them if it's dictionary encoded.
+        """
+        values = self.columns[column] if rows is None \
+            else self.columns[column][rows]
+        if column not in self.dictionaries:
+            return values
+        dictionary = self.dictionaries[column].tolist()
+        return [None if x < 0 else dictionary[x] for x in values.tolist()]
+
+    def where(self, **filters):
+        """
+        Return a boolean mask of the rows matching all the filters,
+        eg. snapshot.where(suite='unstable', architecture='amd64').
+        The filters on dictionary encoded columns take the decoded values,
+        None matching NULL.
+        """
+        mask = self.numpy.ones(len(self), dtype=bool)
+        for column, value in filters.items():
+            if column in self.dictionaries:
+                if value is None:
+                    value = -1
+                else:
+                    value = self.code(column, value)
+                    if value < 0:
+                        return self.numpy.zeros(len(self), dtype=bool)
+            mask &= self.columns[column] == value
+        return mask
+
+
+def load_results_snapshot(path=RESULTS_SNAPSHOT_PATH):
+    """
+    Memory-map the latest results snapshot. Needs python3-numpy.
+    """
+    snapshot = ResultsSnapshot(os.path.join(path, 'current'))
+    log.info('Loaded the results snapshot of %s (%s rows).',
+             snapshot.meta['date'], len(snapshot))
+    return snapshot
 
 
 def start_udd_connection():
@@ -463,21 +1031,54 @@ def package_has_notes(package):
         return False
 
 
+# notes of all packages, loaded once per suite/arch for link_package()
+# (suite, arch) → {package: (issues, bugs, comments)}
+_notes_index = {}
+
+
+def get_notes_index(suite, arch):
+    """
+    Return a dict with the notes of all the packages in suite/arch, loading
+    them from the database with a single query the first time.
+    """
+    try:
+        return _notes_index[(suite, arch)]
+    except KeyError:
+        pass
+    query = """SELECT s.name, n.issues, n.bugs, n.comments
+               FROM notes AS n JOIN sources AS s ON s.id=n.package_id
+               WHERE s.suite=:suite AND s.architecture=:arch"""
+    index = {}
+    for row in query_db(query, {'suite': suite, 'arch': arch}):
+        index.setdefault(row[0], tuple(row[1:]))
+    log.debug('Loaded the notes of %s packages in %s/%s', len(index), suite,
+              arch)
+    _notes_index[(suite, arch)] = index
+    return index
+
+
+def invalidate_notes_index(suite=None, arch=None):
+    """
+    Forget the notes loaded by get_notes_index(), so they are loaded again
+    the next time they are needed. Without arguments all the suites/archs are
+    dropped, otherwise only the given suite and/or arch.
+    """
+    for key in list(_notes_index):
+        if (suite is None or key[0] == suite) and \
+                (arch is None or key[1] == arch):
+            del _notes_index[key]
+
+
 def link_package(package, suite, arch, bugs={}, popcon=None, is_popular=None):
     url = RB_PKG_URI + '/' + suite + '/' + arch + '/' + package + '.html'
-    query = """SELECT n.issues, n.bugs, n.comments
-               FROM notes AS n JOIN sources AS s ON s.id=n.package_id
-               WHERE s.name='{pkg}' AND s.suite='{suite}'
-               AND s.architecture='{arch}'"""
     css_classes = []
     if is_popular:
         css_classes += ["package-popular"]
     title = ''
     if popcon is not None:
         title += 'popcon score: ' + str(popcon) + '\n'
-    try:
-        notes = query_db(query.format(pkg=package, suite=suite, arch=arch))[0]
-    except IndexError:  # no notes for this package
+    notes = get_notes_index(suite, arch).get(package)
+    if notes is None:  # no notes for this package
         css_classes += ["package"]
     else:
         css_classes += ["noted"]
@@ -559,11 +1160,8 @@ def pkg_has_buildinfo(package, version=False, suite=defaultsuite, arch=defaultar
     reproducible db
     """
     if not version:
-        query = """SELECT r.version
-                   FROM results AS r JOIN sources AS s ON r.package_id=s.id
-                   WHERE s.name='{}' AND s.suite='{}' AND s.architecture='{}'"""
-        query = query.format(package, suite, arch)
-        version = str(query_db(query)[0][0])
+        version = str(query_prepared('result_version', package, suite,
+                                     arch)[0][0])
     buildinfo = BUILDINFO_PATH + '/' + suite + '/' + arch + '/' + package + \
                 '_' + strip_epoch(version) + '_' + arch + '.buildinfo'
     if os.access(buildinfo, os.R_OK):
@@ -574,11 +1172,8 @@ def pkg_has_buildinfo(package, version=False, suite=defaultsuite, arch=defaultar
 
 def pkg_has_rbuild(package, version=False, suite=defaultsuite, arch=defaultarch):
     if not version:
-        query = """SELECT r.version
-                   FROM results AS r JOIN sources AS s ON r.package_id=s.id
-                   WHERE s.name='{}' AND s.suite='{}' AND s.architecture='{}'"""
-        query = query.format(package, suite, arch)
-        version = str(query_db(query)[0][0])
+        version = str(query_prepared('result_version', package, suite,
+                                     arch)[0][0])
     rbuild = RBUILD_PATH + '/' + suite + '/' + arch + '/' + package + '_' + \
              strip_epoch(version) + '.rbuild.log'
     if os.access(rbuild, os.R_OK):
@@ -702,10 +1297,10 @@ class Bug:
 
 
 class Issue:
-    def __init__(self, name):
+    def __init__(self, name, result=None):
         self.name = name
-        query = "SELECT url, description  FROM issues WHERE name='{}'"
-        result = query_db(query.format(self.name))
+        if result is None:
+            result = query_prepared('issue', self.name)
         try:
             self.url = result[0][0]
         except IndexError:
@@ -717,57 +1312,66 @@ class Issue:
 
 
 class Note:
-    def __init__(self, pkg, results):
+    def __init__(self, pkg, results, issues=None):
         log.debug(str(results))
-        self.issues = [Issue(x) for x in json.loads(results[0])]
+        if issues is None:
+            self.issues = [Issue(x) for x in json.loads(results[0])]
+        else:
+            self.issues = [Issue(x, issues.get(x, []))
+                           for x in json.loads(results[0])]
         self.bugs = [Bug(x) for x in json.loads(results[1])]
         self.comment = results[2]
 
 
 class NotedPkg:
-    def __init__(self, package, suite, arch):
+    def __init__(self, package, suite, arch, result=None, issues=None):
         self.package = package
         self.suite = suite
         self.arch = arch
-        query = """SELECT n.issues, n.bugs, n.comments
-                   FROM sources AS s JOIN notes AS n ON s.id=n.package_id
-                   WHERE s.name='{}' AND s.suite='{}' AND s.architecture='{}'"""
-        result = query_db(query.format(self.package, self.suite, self.arch))
+        if result is None:
+            result = query_prepared('package_notes', self.package,
+                                    self.suite, self.arch)
         try:
             result = result[0]
         except IndexError:
             self.note = None
         else:
-            self.note = Note(self, result)
+            self.note = Note(self, result, issues)
 
 class Build:
-    def __init__(self, package, suite, arch):
+    def __init__(self, package, suite, arch, result=None):
+        """
+        `result` is an optional, already fetched (status, version, build_date)
+        tuple; pass an empty tuple if the package is not in this suite/arch.
+        """
         self.package = package
         self.suite = suite
         self.arch = arch
         self.status = False
         self.version = False
         self.build_date = False
-        self._get_package_status()
+        if result is None:
+            self._get_package_status()
+        else:
+            self._set_package_status(result)
 
     def _get_package_status(self):
         try:
-            query = """SELECT r.status, r.version, r.build_date
-                       FROM results AS r JOIN sources AS s
-                       ON r.package_id=s.id WHERE s.name='{}'
-                       AND s.architecture='{}' AND s.suite='{}'"""
-            query = query.format(self.package, self.arch, self.suite)
-            result = query_db(query)[0]
+            result = query_prepared('build_status', self.package,
+                                    self.suite, self.arch)[0]
         except IndexError:  # not tested, look whether it actually exists
-            query = """SELECT version FROM sources WHERE name='{}'
-                       AND suite='{}' AND architecture='{}'"""
-            query = query.format(self.package, self.suite, self.arch)
             try:
-                result = query_db(query)[0][0]
+                result = query_prepared('source_version', self.package,
+                                        self.suite, self.arch)[0][0]
                 if result:
                     result = ('untested', str(result), False)
             except IndexError:  # there is no package with this name in this
                 return          # suite/arch, or none at all
+        self._set_package_status(result)
+
+    def _set_package_status(self, result):
+        if not result:
+            return
         self.status = str(result[0])
         self.version = str(result[1])
         if result[2]:
@@ -775,42 +1379,150 @@ class Build:
 
 
 class Package:
-    def __init__(self, name, no_notes=False):
+    def __init__(self, name, no_notes=False, preloaded=None):
+        """
+        `preloaded` is used by Package.load_many() to hand over the data
+        already fetched for a whole batch of packages, it's a dict with
+        the 'status', 'notes', 'issues', 'notify_maintainer' and 'history' keys.
+        """
         self.name = name
         self._status = {}
         for suite in SUITES:
             self._status[suite] = {}
             for arch in ARCHS:
-                self._status[suite][arch] = Build(self.name, suite, arch)
-                if not no_notes:
-                    self.note = NotedPkg(self.name, suite, arch).note
+                if preloaded is None:
+                    self._status[suite][arch] = Build(self.name, suite, arch)
                 else:
+                    self._status[suite][arch] = Build(self.name, suite, arch,
+                        preloaded['status'].get((suite, arch), ()))
+                if no_notes:
                     self.note = False
+                elif preloaded is None:
+                    self.note = NotedPkg(self.name, suite, arch).note
+                else:
+                    self.note = NotedPkg(self.name, suite, arch,
+                        preloaded['notes'].get((suite, arch), []),
+                        preloaded['issues']).note
         try:
             self.status = self._status[defaultsuite][defaultarch].status
         except KeyError:
             self.status = False
-        query = "SELECT notify_maintainer FROM sources WHERE name='{}'"
-        try:
-            result = int(query_db(query.format(self.name))[0][0])
-        except IndexError:
-            result = 0
+        if preloaded is None:
+            try:
+                result = int(query_prepared('notify_maintainer',
+                                            self.name)[0][0])
+            except IndexError:
+                result = 0
+        else:
+            result = preloaded['notify_maintainer']
         self.notify_maint = '⚑' if result == 1 else ''
         self.history = []
-        self._load_history()
+        if preloaded is None:
+            self._load_history()
+        else:
+            self.history = preloaded['history']
+
+    _history_keys = ['build ID', 'version', 'suite', 'architecture', 'result',
+        'build date', 'build duration', 'node1', 'node2', 'job',
+        'schedule message']
 
     def _load_history(self):
-        keys = ['build ID', 'version', 'suite', 'architecture', 'result',
-            'build date', 'build duration', 'node1', 'node2', 'job',
-            'schedule message']
-        query = """
-                SELECT id, version, suite, architecture, status, build_date,
-                    build_duration, node1, node2, job, schedule_message
-                FROM stats_build WHERE name='{}' ORDER BY build_date DESC
-            """.format(self.name)
-        results = query_db(query)
+        results = query_prepared('package_history', self.name)
         for record in results:
-            self.history.append(dict(zip(keys, record)))
+            self.history.append(dict(zip(self._history_keys, record)))
+
+    @classmethod
+    def load_many(cls, names, no_notes=False, batch_size=1000):
+        """
+        Returns a list of Package objects, one for each of the given names.
+
+        Instead of running a bunch of queries for every single suite/arch of
+        every single package (as Package() does), the data is fetched with a
+        handful of queries for every batch of `batch_size` packages.
+        """
+        names = sorted(set(names))
+        issues = None
+        if not no_notes:
+            issues = {}
+            for name, url, desc in query_db(
+                    'SELECT name, url, description FROM issues'):
+                issues[name] = [(url, desc)]
+        packages = []
+        for i in range(0, len(names), batch_size):
+            batch = names[i:i+batch_size]
+            log.debug('Loading %s packages (%s/%s)', len(batch),
+                      i+len(batch), len(names))
+            packages.extend(cls._load_batch(batch, no_notes, issues))
+        return packages
+
+    @classmethod
+    def _load_batch(cls, names, no_notes, issues):
+        sources = db_table('sources')
+        results = db_table('results')
+        stats_build = db_table('stats_build')
+        preloaded = {}
+        for name in names:
+            preloaded[name] = {
+                'status': {},
+                'notes': {},
+                'issues': issues,
+                'notify_maintainer': 0,
+                'history': [],
+            }
+
+        query = sql.select([
+            sources.c.name, sources.c.suite, sources.c.architecture,
+            sources.c.version, sources.c.notify_maintainer,
+            results.c.status, results.c.version, results.c.build_date,
+        ]).select_from(
+            sources.join(results, isouter=True)
+        ).where(sources.c.name.in_(names))
+        notify_maintainer = {}
+        for row in query_db(query):
+            name, suite, arch, sversion, notify, status, rversion, date = row
+            notify_maintainer.setdefault(name, int(notify))
+            if status is not None:
+                result = (status, rversion, date)
+            elif sversion:   # not tested yet
+                result = ('untested', str(sversion), False)
+            else:
+                continue
+            preloaded[name]['status'][(suite, arch)] = result
+
+        if not no_notes:
+            notes = db_table('notes')
+            query = sql.select([
+                sources.c.name, sources.c.suite, sources.c.architecture,
+                notes.c.issues, notes.c.bugs, notes.c.comments,
+            ]).select_from(
+                sources.join(notes)
+            ).where(sources.c.name.in_(names))
+            rows = query_db(query)
+            for name, suite, arch, n_issues, n_bugs, n_comments in rows:
+                preloaded[name]['notes'].setdefault((suite, arch), []).append(
+                    (n_issues, n_bugs, n_comments))
+
+        query = sql.select([
+            stats_build.c.name, stats_build.c.id, stats_build.c.version,
+            stats_build.c.suite, stats_build.c.architecture,
+            stats_build.c.status, stats_build.c.build_date,
+            stats_build.c.build_duration, stats_build.c.node1,
+            stats_build.c.node2, stats_build.c.job,
+            stats_build.c.schedule_message,
+        ]).where(
+            stats_build.c.name.in_(names)
+        ).order_by(stats_build.c.name, sql.desc(stats_build.c.build_date))
+        for record in query_db(query):
+            preloaded[record[0]]['history'].append(
+                dict(zip(cls._history_keys, record[1:])))
+
+        packages = []
+        for name in names:
+            preloaded[name]['notify_maintainer'] = \
+                notify_maintainer.get(name, 0)
+            packages.append(cls(name, no_notes=no_notes,
+                                preloaded=preloaded[name]))
+        return packages
 
     def get_status(self, suite, arch):
         """ This returns False if the package does not exists in this suite """
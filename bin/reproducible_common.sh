@@ -526,11 +526,13 @@ link_packages() {
 }
 
 gen_package_html() {
+	local RET=0
 	cd /srv/jenkins/bin
 	python3 -c "import reproducible_html_packages as rep
 pkg = rep.Package('$1', no_notes=True)
-rep.gen_packages_html([pkg], no_clean=True)" || echo "Warning: cannot update HTML pages for $1"
+rep.gen_packages_html([pkg], no_clean=True)" || { echo "Warning: cannot update HTML pages for $1" ; RET=1 ; }
 	cd - > /dev/null
+	return $RET
 }
 
 calculate_build_duration() {
@@ -644,6 +646,38 @@ cleanup_pkg_files() {
 	rm -vf $DEBIAN_BASE/logdiffs/${SUITE}/${ARCH}/${SRCPACKAGE}_*.diff{,.gz}
 }
 
+#
+# long-lived graph renderer, so that start-up is paid once per job and not
+# once per png, see serve() in reproducible_graphs.py
+#
+start_graph_worker() {
+	coproc GRAPH_WORKER { /srv/jenkins/bin/reproducible_graphs.py --skip-database-connection --batch ; }
+}
+
+stop_graph_worker() {
+	if [ -n "$GRAPH_WORKER_PID" ] ; then
+		echo >&${GRAPH_WORKER[1]}
+		wait $GRAPH_WORKER_PID || true
+	fi
+}
+
+#
+# render a graph, with the same arguments as reproducible_graphs.py
+# (through the graph worker if it's running)
+#
+render_graph() {
+	if [ -n "$GRAPH_WORKER_PID" ] ; then
+		echo "$(printf '%q ' "$@")" >&${GRAPH_WORKER[1]}
+		local REPLY
+		read -r REPLY <&${GRAPH_WORKER[0]}
+		if [ "$REPLY" != "OK" ] ; then
+			echo "Warning: could not render $2: $REPLY"
+		fi
+	else
+		/srv/jenkins/bin/reproducible_graphs.py --skip-database-connection "$@"
+	fi
+}
+
 #
 # create the png (and query the db to populate a csv file...)
 #
@@ -768,7 +802,7 @@ create_png_from_table() {
 		DIR=$(dirname $2)
 		mkdir -p $DIR
 		echo "Generating $2."
-		/srv/jenkins/bin/make_graph.py ${TABLE[$1]}.csv $2 ${COLORS} "${MAINLABEL[$1]}" "${YLABEL[$1]}" $WIDTH $HEIGHT
+		render_graph $PWD/${TABLE[$1]}.csv $PWD/$2 ${COLORS} "${MAINLABEL[$1]}" "${YLABEL[$1]}" $WIDTH $HEIGHT
 		mv $2 $DEBIAN_BASE/$DIR
 		[ "$DIR" = "." ] || rmdir $(dirname $2)
 	# create empty dummy png if there havent been any results ever
@@ -627,6 +627,15 @@ schema_updates = {
                     AND b.architecture=sr.architecture""",
         "INSERT INTO rb_schema (version, date) VALUES (32, '" + now + "')"
     ],
+    33: [ # journal of packages whose rb-pkg pages need to be regenerated
+        """CREATE TABLE rb_pkg_journal
+                     (id SERIAL PRIMARY KEY,
+                      name TEXT NOT NULL,
+                      suite TEXT NOT NULL,
+                      architecture TEXT NOT NULL,
+                      date_added TEXT NOT NULL)""",
+        "INSERT INTO rb_schema (version, date) VALUES (33, '" + now + "')"
+    ],
 }
 
 
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Depends: python3 python3-matplotlib
+#
+# Render the stacked bar charts of the stats tables, in process, and write
+# the thumbnail at the same time as the graph.
+#
+# Also usable from the command line:
+#   reproducible_graphs.py csv-file-in png-out-file colors mainlabel ylabel width height
+# or, to render many graphs paying the start-up cost only once, as a worker
+# reading those arguments from a pipe, see serve() and start_graph_worker in
+# reproducible_common.sh:
+#   reproducible_graphs.py --batch
+
+import csv
+import shlex
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from reproducible_common import *
+
+
+THUMB_SIZE = (160, 80)
+
+# thanks to http://tango.freedesktop.org/Generic_Icon_Theme_Guidelines for those nice colors
+PALETTE_SMALL = ['#73d216', '#f57900', '#cc0000', '#2e3436', '#888a85']
+PALETTE_16 = ['#4e9a06', '#57a231', '#73d216', '#8ae234',
+              '#ce5c00', '#f57900', '#fcaf3e', '#fcda27',
+              '#a40000', '#cc0000', '#ef2929', '#fc2a1a',
+              '#2e3436', '#555753', '#888a85', '#b8bbb4']
+PALETTE_BIG = ['#fce94f', '#c4a000', '#eeeeec', '#babdb6',
+               '#fcaf3e', '#ce5c00', '#ad7fa8', '#5c3566',
+               '#e9b96e', '#8f5902', '#8ae234', '#4e9a06',
+               '#729fcf', '#204a87', '#ef2929', '#a40000',
+               '#888a85', '#2e3436', '#75507b', '#cc0000',
+               '#ce5c00', '#73d216', '#edd400', '#f57900',
+               '#c17d11', '#3465a4', '#666666', '#aaaaaa',
+               '#aa00aa', '#ff55ff', '#123456', '#7890ab']
+# colors >= 40 are a hack to draw a single series with a different color
+PALETTE_SINGLE = {
+    40: ['#4e9a06', '#000000'],
+    41: ['#57a231', '#000000'],
+    42: ['#73d216', '#000000'],
+    43: ['#8ae234', '#000000'],
+}
+
+
+def get_palette(colors):
+    """
+    Return the palette to use for `colors`, and the number of series
+    actually drawn.
+    """
+    if colors in PALETTE_SINGLE:
+        return PALETTE_SINGLE[colors], 1
+    if colors < 6:
+        return PALETTE_SMALL, colors
+    if colors == 16:
+        return PALETTE_16, colors
+    return PALETTE_BIG, colors
+
+
+def legend_columns(colors):
+    if colors < 10:
+        return 2
+    if colors == 16:
+        return 4
+    return 7
+
+
+def render_graph(rows, labels, png_file, colors, main_label, y_label,
+                 width=1920, height=960, thumb_file=None):
+    """
+    Draw `rows` (as returned by query_db(): the date first, then one value
+    per label) as a stacked bar chart into png_file, and into thumb_file
+    (THUMB_SIZE) if given.
+    """
+    palette, series = get_palette(int(colors))
+    fig = Figure(figsize=(width / 100, height / 100), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    x = range(len(rows))
+    bottom = [0] * len(rows)
+    for i in range(min(series, len(labels))):
+        values = [row[i+1] or 0 for row in rows]
+        ax.bar(x, values, width=1.0, bottom=bottom, align='edge',
+               color=palette[i % len(palette)], linewidth=0)
+        bottom = [a + b for a, b in zip(bottom, values)]
+    ax.set_xlim(0, max(len(rows), 1))
+    # about a dozen date labels, however long the series is
+    step = max(1, -(-len(rows) // 12))
+    ax.set_xticks([i + 0.5 for i in range(0, len(rows), step)])
+    ax.set_xticklabels([str(rows[i][0]) for i in range(0, len(rows), step)])
+    ax.set_title(main_label, fontweight='bold')
+    ax.set_ylabel(y_label)
+    # like R's legend(), the palette is recycled for all the columns
+    handles = [Patch(color=palette[i % len(palette)], label=label)
+               for i, label in enumerate(labels)]
+    fig.legend(handles=handles, loc='lower center', frameon=False,
+               ncol=legend_columns(int(colors)))
+    legend_lines = -(-len(labels) // legend_columns(int(colors)))
+    fig.subplots_adjust(left=0.05, right=0.98, top=0.94,
+                        bottom=0.06 + 0.025 * legend_lines)
+    fig.savefig(png_file, dpi=100)
+    if thumb_file:
+        fig.savefig(thumb_file, dpi=100 * min(THUMB_SIZE[0] / width,
+                                              THUMB_SIZE[1] / height))
+    log.debug('Graph written to %s.', png_file)
+
+
+def get_watermarks(table, where='', group_by=None):
+    """
+    Return what identifies the current state of the series stored in the
+    stats `table`: (max(datum), row count), as the stats tables only ever
+    get new rows.
+    With `group_by`, return a dict of them for every value of that column.
+    """
+    fields = 'max(datum), count(*)'
+    if group_by:
+        fields = group_by + ', ' + fields
+    query = 'SELECT {fields} FROM {table} {where}'.format(
+        fields=fields, table=table, where=where)
+    if group_by:
+        query += ' GROUP BY ' + group_by
+        return {row[0]: [str(row[1]), row[2]] for row in query_db(query)}
+    row = query_db(query)[0]
+    return [str(row[0]), row[1]]
+
+
+class GraphCache:
+    """
+    Remember the data each graph has been rendered from, keyed by
+    (table, filter, max(datum), row count), to only render again the graphs
+    whose series changed.
+    Each job has its own cache file in GRAPH_CACHE_PATH.
+    """
+    def __init__(self, name):
+        self.path = os.path.join(GRAPH_CACHE_PATH, name + '.json')
+        try:
+            with open(self.path) as fd:
+                self.cache = json.load(fd)
+        except (OSError, ValueError):
+            self.cache = {}
+        self.fresh = 0
+        self.stale = 0
+
+    def is_fresh(self, png_file, key, thumb_file=None):
+        """
+        Whether png_file (and thumb_file) exist and have been rendered from
+        the data identified by `key`.
+        """
+        fresh = self.cache.get(png_file) == list(key) and \
+            all(os.access(x, os.R_OK) for x in (png_file, thumb_file) if x)
+        if fresh:
+            self.fresh += 1
+        else:
+            self.stale += 1
+        return fresh
+
+    def update(self, png_file, key):
+        self.cache[png_file] = list(key)
+
+    def save(self):
+        log.info('%s graphs were up to date, %s had to be rendered.',
+                 self.fresh, self.stale)
+        try:
+            os.makedirs(GRAPH_CACHE_PATH, exist_ok=True)
+            with NamedTemporaryFile(mode='w', delete=False,
+                                    dir=GRAPH_CACHE_PATH) as fd:
+                json.dump(self.cache, fd)
+            os.rename(fd.name, self.path)
+        except OSError as e:
+            log.warning('Could not save %s: %s', self.path, e)
+
+
+def read_csv(csv_file):
+    """
+    Read a csv file as written by the shell jobs: a header line, then the
+    rows, with the date in the first column.
+    Returns (labels, rows).
+    """
+    with open(csv_file) as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = [[row[0]] + [float(x) if x else 0 for x in row[1:]]
+                for row in reader]
+    return header[1:], rows
+
+
+def render_job(job):
+    """
+    Render a graph from the command line arguments:
+    csv-file-in png-out-file colors mainlabel ylabel width height
+    """
+    if len(job) != 7:
+        raise ValueError('we need exactly seven params: csv-file-in, '
+                         'png-out-file, color, mainlabel, ylabel, width, '
+                         'height')
+    csv_file, png_file, colors, main_label, y_label, width, height = job
+    labels, rows = read_csv(csv_file)
+    render_graph(rows, labels, png_file, int(colors), main_label, y_label,
+                 int(width), int(height))
+
+
+def serve(infile=sys.stdin, outfile=sys.stdout):
+    """
+    Render graphs in a loop, reading one job per line from `infile`: the
+    command line arguments, quoted like in a shell.
+    For every job either "OK" or "ERROR <message>" is written to `outfile`
+    once the png is complete. An empty line or EOF stops the loop.
+    """
+    count = 0
+    for line in infile:
+        if not line.strip():
+            break
+        try:
+            render_job(shlex.split(line))
+        except Exception as e:
+            log.error('Could not render %s: %s', line.strip(), e)
+            print('ERROR', str(e).replace('\n', ' '), file=outfile, flush=True)
+        else:
+            count += 1
+            print('OK', file=outfile, flush=True)
+    log.info('Rendered %s graphs.', count)
+
+
+if __name__ == '__main__':
+    local_parser = argparse.ArgumentParser(
+        description='Render graphs of the stats tables')
+    local_parser.add_argument('--batch', action='store_true',
+        help='read the arguments of many graphs from stdin, one graph per '
+             'line, and write "OK" or "ERROR <message>" to stdout for each')
+    local_args, job = local_parser.parse_known_args(unknown_args)
+    if local_args.batch:
+        serve()
+    else:
+        try:
+            render_job(job)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
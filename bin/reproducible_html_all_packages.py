@@ -11,7 +11,8 @@
 # code already written in reproducible_html_packages
 
 
+from reproducible_common import args
 from reproducible_html_packages import gen_all_rb_pkg_pages
 
 
-gen_all_rb_pkg_pages(no_clean=True)
+gen_all_rb_pkg_pages(no_clean=True, jobs=args.jobs)
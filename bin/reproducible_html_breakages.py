@@ -12,23 +12,139 @@
 
 from reproducible_common import *
 import time
+import gzip
+import mmap
 import os.path
+from collections import namedtuple
+from reproducible_graphs import GraphCache, get_watermarks, render_graph
+
+Artifact = namedtuple('Artifact', ['suite', 'arch', 'pkg', 'version', 'path',
+                                   'size', 'mtime'])
+
+# the trees of files laid out as <tree>/<suite>/<arch>/
+ARTIFACT_TREES = {
+    'rbuild': RBUILD_PATH,
+    'logs': LOGS_PATH,
+    'logdiffs': DIFFS_PATH,
+    'dbd': DBD_PATH,
+    'dbdtxt': DBDTXT_PATH,
+    'buildinfo': BUILDINFO_PATH,
+    'rb-pkg': RB_PKG_PATH,
+}
+
+
+def parse_artifact(kind, filename):
+    """
+    Return the (package, version) a file is about, or raise ValueError.
+    rb-pkg pages are only about a package, so their version is None.
+    """
+    if kind == 'rb-pkg':
+        return filename.rsplit('.', 1)[0], None
+    if kind == 'buildinfo':
+        pkg, version = filename.rsplit('.', 1)[0].split('_')[:2]
+        return pkg, version
+    # different file have differnt name patterns and different splitting needs
+    if filename.endswith('.diff.gz'):
+        rsplit_level = 2
+    elif filename.endswith('.gz'):
+        rsplit_level = 3
+    else:
+        rsplit_level = 2
+    pkg, version = filename.rsplit('.', rsplit_level)[0].rsplit('_', 1)
+    return pkg, version
+
+
+class ArtifactIndex:
+    """
+    In-memory index of all the files in ARTIFACT_TREES, built with a single
+    scan_trees(), so that the checks below don't need to access the
+    filesystem for every package.
+    """
+    def __init__(self):
+        self.artifacts = {}
+        self.keys = {}
+        log.info('Scanning ' + ', '.join(sorted(ARTIFACT_TREES.values())) +
+                 '...')
+        for kind, entries in scan_trees(ARTIFACT_TREES).items():
+            artifacts = []
+            for entry in entries:
+                try:
+                    pkg, version = parse_artifact(kind, entry.name)
+                except ValueError:
+                    log.critical(bcolors.FAIL + entry.path +
+                                 ' does not seem to be a file that should be there'
+                                 + bcolors.ENDC)
+                    continue
+                artifacts.append(Artifact(entry.suite, entry.arch, pkg,
+                                          version, entry.path, entry.size,
+                                          entry.mtime))
+            self.artifacts[kind] = sorted(artifacts, key=lambda x: x.path)
+            self.keys[kind] = {}
+            for artifact in self.artifacts[kind]:
+                self.keys[kind].setdefault(artifact[:4], []).append(artifact)
+            log.info('Found %s files in %s.', len(artifacts),
+                     ARTIFACT_TREES[kind])
+
+    def has(self, kind, suite, arch, pkg, version):
+        return (suite, arch, pkg, version) in self.keys[kind]
+
+    def get(self, kind, suite, arch, pkg, version):
+        """
+        Return the list of files of `kind` for this package version, sorted
+        by path (so eg. a .rbuild.log comes before its .rbuild.log.gz).
+        """
+        return self.keys[kind].get((suite, arch, pkg, version), [])
+
+
+_artifacts = None
+
+
+def get_artifacts():
+    global _artifacts
+    if _artifacts is None:
+        _artifacts = ArtifactIndex()
+    return _artifacts
+
+
+_results = None
+
+
+def get_results():
+    """
+    Return the name, version, suite, arch and status of all the tested
+    packages, loaded with a single query.
+    """
+    global _results
+    if _results is None:
+        query = '''SELECT s.name, r.version, s.suite, s.architecture, r.status
+                   FROM sources AS s JOIN results AS r ON r.package_id=s.id
+                   ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
+        _results = query_db(query)
+    return _results
+
+
+def select_results(statuses=None, exclude=None, suites=None):
+    """
+    Filter the results returned by get_results(), on their status and/or suite.
+    """
+    return [(pkg, version, suite, arch)
+            for pkg, version, suite, arch, status in get_results()
+            if (statuses is None or status in statuses) and
+            (exclude is None or status not in exclude) and
+            (suites is None or suite in suites)]
+
 
 def unrep_with_dbd_issues():
     log.info('running unrep_with_dbd_issues check...')
     without_dbd = []
     bad_dbd = []
     sources_without_dbd = set()
-    query = '''SELECT s.name, r.version, s.suite, s.architecture
-               FROM sources AS s JOIN results AS r ON r.package_id=s.id
-               WHERE r.status='unreproducible'
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
-    for pkg, version, suite, arch in results:
+    artifacts = get_artifacts()
+    for pkg, version, suite, arch in select_results(('unreproducible',)):
         eversion = strip_epoch(version)
         dbd = DBD_PATH + '/' + suite + '/' + arch + '/' + pkg + '_' + \
             eversion + '.diffoscope.html'
-        if not os.access(dbd, os.R_OK):
+        if not artifacts.has('dbd', suite, arch, pkg, eversion):
             without_dbd.append((pkg, version, suite, arch))
             sources_without_dbd.add(pkg)
             log.warning(suite + '/' + arch + '/' + pkg + ' (' + version + ') is '
@@ -45,25 +161,17 @@ def unrep_with_dbd_issues():
     return without_dbd, bad_dbd, sources_without_dbd
 
 def count_pkgs(pkgs_to_count=[]):
-    counted_pkgs = []
-    for pkg, version, suite, arch in pkgs_to_count:
-         if pkg not in counted_pkgs:
-             counted_pkgs.append(pkg)
-    return len(counted_pkgs)
+    return len(set(x[0] for x in pkgs_to_count))
 
 def not_unrep_with_dbd_file():
     log.info('running not_unrep_with_dbd_file check...')
     bad_pkgs = []
-    query = '''SELECT s.name, r.version, s.suite, s.architecture
-               FROM sources AS s JOIN results AS r ON r.package_id=s.id
-               WHERE r.status != 'unreproducible'
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
-    for pkg, version, suite, arch in results:
+    artifacts = get_artifacts()
+    for pkg, version, suite, arch in select_results(exclude=('unreproducible',)):
         eversion = strip_epoch(version)
-        dbd = DBD_PATH + '/' + suite + '/' + arch + '/' + pkg + '_' + \
-            eversion + '.diffoscope.html'
-        if os.access(dbd, os.R_OK):
+        if artifacts.has('dbd', suite, arch, pkg, eversion):
+            dbd = DBD_PATH + '/' + suite + '/' + arch + '/' + pkg + '_' + \
+                eversion + '.diffoscope.html'
             bad_pkgs.append((pkg, version, suite, arch))
             log.warning(dbd + ' exists but ' + suite + '/' + arch + '/' + pkg + ' (' + version + ')'
                         ' is not unreproducible.')
@@ -73,13 +181,9 @@ def not_unrep_with_dbd_file():
 def lack_rbuild():
     log.info('running lack_rbuild check...')
     bad_pkgs = []
-    query = '''SELECT s.name, r.version, s.suite, s.architecture
-               FROM sources AS s JOIN results AS r ON r.package_id=s.id
-               WHERE r.status NOT IN ('blacklisted', '')
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
-    for pkg, version, suite, arch in results:
-        if not pkg_has_rbuild(pkg, version, suite, arch):
+    artifacts = get_artifacts()
+    for pkg, version, suite, arch in select_results(exclude=('blacklisted', '')):
+        if not artifacts.has('rbuild', suite, arch, pkg, strip_epoch(version)):
             bad_pkgs.append((pkg, version, suite, arch))
             log.warning(suite + '/' + arch + '/' + pkg + ' (' + version + ') has been '
                         'built, but a buildlog is missing.')
@@ -89,50 +193,115 @@ def lack_rbuild():
 def lack_buildinfo():
     log.info('running lack_buildinfo check...')
     bad_pkgs = []
-    query = '''SELECT s.name, r.version, s.suite, s.architecture
-               FROM sources AS s JOIN results AS r ON r.package_id=s.id
-               WHERE r.status NOT IN
-                ('blacklisted', 'not for us', 'FTBFS', 'depwait', '404', '')
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
-    for pkg, version, suite, arch in results:
-        eversion = strip_epoch(version)
-        buildinfo = BUILDINFO_PATH + '/' + suite + '/' + arch + '/' + pkg + \
-            '_' + eversion + '_' + arch + '.buildinfo'
-        if not os.access(buildinfo, os.R_OK):
+    artifacts = get_artifacts()
+    for pkg, version, suite, arch in select_results(exclude=(
+            'blacklisted', 'not for us', 'FTBFS', 'depwait', '404', '')):
+        if not artifacts.has('buildinfo', suite, arch, pkg, strip_epoch(version)):
             bad_pkgs.append((pkg, version, suite, arch))
             log.warning(suite + '/' + arch + '/' + pkg + ' (' + version + ') has been '
                         'successfully built, but a .buildinfo is missing')
     return bad_pkgs
 
 
+PBUILDER_DEP_FAIL = b'E: pbuilder-satisfydepends failed.'
+
+
+def log_contains(path, needle):
+    """
+    Whether the file at `path`, possibly gzipped, contains `needle`.
+    Plain files are memory-mapped, gzipped ones are decompressed in chunks.
+    """
+    if path.endswith('.gz'):
+        tail = b''
+        with gzip.open(path, 'rb') as fd:
+            while True:
+                chunk = fd.read(1024*1024)
+                if not chunk:
+                    return False
+                if (tail + chunk).find(needle) != -1:
+                    return True
+                tail = (tail + chunk)[-len(needle)+1:]
+    with open(path, 'rb') as fd:
+        try:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm.find(needle) != -1
+        except ValueError:  # empty file, it can't be mapped
+            return False
+
+
 def pbuilder_dep_fail():
     log.info('running pbuilder_dep_fail check...')
     bad_pkgs = []
+    artifacts = get_artifacts()
+    # the logs never change once written, so remember what was found in them
+    # (path → [size, mtime, found]) and only read the new ones
+    try:
+        with open(PBUILDER_DEP_FAIL_CACHE) as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        cache = {}
+    new_cache = {}
+    read = 0
     # we only care about these failures in the !unstable !experimental suites
     # as they happen all the time in there, as packages are buggy
     # and specific versions also come and go
-    query = '''SELECT s.name, r.version, s.suite, s.architecture
-               FROM sources AS s JOIN results AS r ON r.package_id=s.id
-               WHERE r.status = 'FTBFS'
-               AND s.suite NOT IN ('unstable', 'experimental')
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    results = query_db(query)
-    for pkg, version, suite, arch in results:
-        eversion = strip_epoch(version)
-        rbuild = RBUILD_PATH + '/' + suite + '/' + arch + '/' + pkg + '_' + \
-            eversion + '.rbuild.log'
-        if os.access(rbuild, os.R_OK):
-            log.debug('\tlooking at ' + rbuild)
-            with open(rbuild, "br") as fd:
-                for line in fd:
-                    if re.search(b'E: pbuilder-satisfydepends failed.', line):
-                        bad_pkgs.append((pkg, version, suite, arch))
-                        log.warning(suite + '/' + arch + '/' + pkg + ' (' + version +
-                                    ') failed to satisfy its dependencies.')
+    suites = [x for x in SUITES if x not in ('unstable', 'experimental')]
+    for pkg, version, suite, arch in select_results(('FTBFS',), suites=suites):
+        rbuilds = artifacts.get('rbuild', suite, arch, pkg, strip_epoch(version))
+        if not rbuilds:
+            continue
+        rbuild = rbuilds[0]
+        cached = cache.get(rbuild.path)
+        if cached and cached[:2] == [rbuild.size, rbuild.mtime]:
+            found = cached[2]
+        else:
+            log.debug('\tlooking at ' + rbuild.path)
+            try:
+                found = log_contains(rbuild.path, PBUILDER_DEP_FAIL)
+            except (OSError, EOFError) as e:
+                log.warning('Could not read %s: %s', rbuild.path, e)
+                continue
+            read += 1
+        new_cache[rbuild.path] = [rbuild.size, rbuild.mtime, found]
+        if found:
+            bad_pkgs.append((pkg, version, suite, arch))
+            log.warning(suite + '/' + arch + '/' + pkg + ' (' + version +
+                        ') failed to satisfy its dependencies.')
+    log.info('%s rbuild logs read, %s known from the cache.', read,
+             len(new_cache) - read)
+    try:
+        with NamedTemporaryFile(mode='w', delete=False,
+                dir=os.path.dirname(PBUILDER_DEP_FAIL_CACHE)) as fd:
+            json.dump(new_cache, fd)
+        os.rename(fd.name, PBUILDER_DEP_FAIL_CACHE)
+    except OSError as e:
+        log.warning('Could not save %s: %s', PBUILDER_DEP_FAIL_CACHE, e)
     return bad_pkgs
 
 
+def remove_alien_files(artifacts, known_versions, message=''):
+    """
+    Remove the files whose version is not the one in `known_versions`
+    ((suite, arch, pkg) → version), if older than a day.
+    Returns the files that should not be there, but were kept.
+    """
+    bad_files = []
+    for artifact in artifacts:
+        rversion = known_versions.get(artifact[:3], '')
+        if strip_epoch(rversion) != artifact.version:
+            path = artifact.path
+            try:
+                if artifact.mtime<time.time()-86400:
+                    os.remove(path)
+                    log.warning(path + ' should not be there and and was older than a day so it was removed.')
+                else:
+                    bad_files.append(path)
+                    log.info(path + ' should not be there, but is also less than 24h old and will probably soon be gone.' + message)
+            except FileNotFoundError:
+                pass  # that bad file is already gone.
+    return bad_files
+
+
 def alien_log(directory=None):
     if directory is None:
         bad_files = []
@@ -140,84 +309,19 @@ def alien_log(directory=None):
             bad_files.extend(alien_log(path))
         return bad_files
     log.info('running alien_log check over ' + directory + '...')
-    query = '''SELECT r.version
-               FROM sources AS s JOIN results AS r ON r.package_id=s.id
-               WHERE r.status != '' AND s.name='{pkg}' AND s.suite='{suite}'
-               AND s.architecture='{arch}'
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    bad_files = []
-    for root, dirs, files in os.walk(directory):
-        if not files:
-            continue
-        suite, arch = root.rsplit('/', 2)[1:]
-        for file in files:
-            # different file have differnt name patterns and different splitting needs
-            if file.endswith('.diff.gz'):
-                rsplit_level = 2
-            elif file.endswith('.gz'):
-                rsplit_level = 3
-            else:
-                rsplit_level = 2
-            try:
-                pkg, version = file.rsplit('.', rsplit_level)[0].rsplit('_', 1)
-            except ValueError:
-                log.critical(bcolors.FAIL + '/'.join([root, file]) +
-                             ' does not seem to be a file that should be there'
-                             + bcolors.ENDC)
-                continue
-            try:
-                rversion = query_db(query.format(pkg=pkg, suite=suite, arch=arch))[0][0]
-            except IndexError:  # that package is not known (or not yet tested)
-                rversion = ''   # continue towards the "bad file" path
-            if strip_epoch(rversion) != version:
-                try:
-                    if os.path.getmtime('/'.join([root, file]))<time.time()-86400:
-                        os.remove('/'.join([root, file]))
-                        log.warning('/'.join([root, file]) + ' should not be there and and was older than a day so it was removed.')
-                    else:
-                        bad_files.append('/'.join([root, file]))
-                        log.info('/'.join([root, file]) + ' should not be there, but is also less than 24h old and will probably soon be gone. Probably diffoscope is running on that package right now.')
-                except FileNotFoundError:
-                    pass  # that bad file is already gone.
-    return bad_files
+    kind = [k for k, v in ARTIFACT_TREES.items() if v == directory][0]
+    known_versions = {(suite, arch, pkg): version for pkg, version, suite, arch
+                      in select_results(exclude=('',))}
+    return remove_alien_files(get_artifacts().artifacts[kind], known_versions,
+        ' Probably diffoscope is running on that package right now.')
 
 
 def alien_buildinfo():
     log.info('running alien_buildinfo check...')
-    query = '''SELECT r.version
-               FROM sources AS s JOIN results AS r ON r.package_id=s.id
-               WHERE r.status != '' AND s.name='{pkg}' AND s.suite='{suite}'
-               AND s.architecture='{arch}'
-               AND r.status IN ('reproducible', 'unreproducible')
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
-    bad_files = []
-    for root, dirs, files in os.walk(BUILDINFO_PATH):
-        if not files:
-            continue
-        suite, arch = root.rsplit('/', 2)[1:]
-        for file in files:
-            try:
-                pkg, version = file.rsplit('.', 1)[0].split('_')[:2]
-            except ValueError:
-                log.critical(bcolors.FAIL + '/'.join([root, file]) +
-                             ' does not seem to be a file that should be there'
-                             + bcolors.ENDC)
-                continue
-            try:
-                rversion = query_db(query.format(pkg=pkg, suite=suite, arch=arch))[0][0]
-            except IndexError:  # that package is not known (or not yet tested)
-                rversion = ''   # continue towards the "bad file" path
-            if strip_epoch(rversion) != version:
-                try:
-                    if os.path.getmtime('/'.join([root, file]))<time.time()-86400:
-                        os.remove('/'.join([root, file]))
-                        log.warning('/'.join([root, file]) + ' should not be there and and was older than a day so it was removed.')
-                    else:
-                        bad_files.append('/'.join([root, file]))
-                        log.info('/'.join([root, file]) + ' should not be there, but is also less than 24h old and will probably soon be gone.')
-                except FileNotFoundError:
-                    pass  # that bad file is already gone.
-    return bad_files
+    known_versions = {(suite, arch, pkg): version for pkg, version, suite, arch
+                      in select_results(('reproducible', 'unreproducible'))}
+    return remove_alien_files(get_artifacts().artifacts['buildinfo'],
+                              known_versions)
 
 
 def alien_dbd(directory=None):
@@ -230,29 +334,13 @@ def alien_dbd(directory=None):
 
 def alien_rbpkg():
     log.info('running alien_rbpkg check...')
-    query = '''SELECT s.name
-               FROM sources AS s
-               WHERE s.name='{pkg}' AND s.suite='{suite}'
-               AND s.architecture='{arch}'
-               ORDER BY s.name ASC, s.suite DESC, s.architecture ASC'''
+    query = 'SELECT s.name, s.suite, s.architecture FROM sources AS s'
+    sources = set((suite, arch, pkg) for pkg, suite, arch in query_db(query))
     bad_files = []
-    for root, dirs, files in os.walk(RB_PKG_PATH):
-        if not files:
-            continue
-        # Extract the "suite" and "arch" from the directory structure
-        if os.path.split(root)[1] == 'diffoscope-results':
-            # We are presently inspecting package pages in the
-            # RB_PKG_PATH/{{suite}}/{{arch}}/diffoscope-results directory
-            suite, arch = os.path.split(root)[0].rsplit('/', 2)[1:]
-        else:
-            # We are presently inspecting package pages in the
-            # RB_PKG_PATH/{{suite}}/{{arch}}/ directory
-            suite, arch = root.rsplit('/', 2)[1:]
-        for file in files:
-            pkg = file.rsplit('.', 1)[0]
-            if not query_db(query.format(pkg=pkg, suite=suite, arch=arch)):
-                bad_files.append('/'.join([root, file]))
-                log.warning('/'.join([root, file]) + ' should not be there')
+    for artifact in get_artifacts().artifacts['rb-pkg']:
+        if artifact[:3] not in sources:
+            bad_files.append(artifact.path)
+            log.warning(artifact.path + ' should not be there')
     return bad_files
 
 
@@ -299,21 +387,19 @@ def create_breakages_graph(png_file, main_label):
     columns = ["datum", "diffoscope_timeouts", "diffoscope_crashes"]
     query = "SELECT {fields} FROM {table} ORDER BY datum".format(
         fields=", ".join(columns), table=table)
+    graph_cache = GraphCache('breakages')
+    key = [table, ''] + get_watermarks(table)
+    if graph_cache.is_fresh(png_fullpath, key):
+        log.info("The graph for stats_breakages is up to date.")
+        return
     result = query_db(query)
-    result_rearranged = [dict(zip(columns, row)) for row in result]
-
-    with create_temp_file(mode='w') as f:
-        csv_tmp_file = f.name
-        csv_writer = csv.DictWriter(f, columns)
-        csv_writer.writeheader()
-        csv_writer.writerows(result_rearranged)
-        f.flush()
-
-        graph_command = os.path.join(BIN_PATH, "make_graph.py")
-        y_label = "Amount (packages)"
-        log.info("Creating graph for stats_breakges.")
-        check_call([graph_command, csv_tmp_file, png_fullpath, '2', main_label,
-                    y_label, '1920', '960'])
+
+    y_label = "Amount (packages)"
+    log.info("Creating graph for stats_breakges.")
+    render_graph(result, columns[1:], png_fullpath, 2, main_label, y_label,
+                 1920, 960)
+    graph_cache.update(png_fullpath, key)
+    graph_cache.save()
 
 
 def update_stats_breakages(diffoscope_timeouts, diffoscope_crashes):
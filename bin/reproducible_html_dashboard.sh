@@ -708,6 +708,7 @@ create_variations_page() {
 # main
 #
 SUITE="unstable"
+start_graph_worker
 update_bug_stats
 update_notes_stats
 for ARCH in ${ARCHS} ; do
@@ -721,4 +722,5 @@ create_performance_page
 create_variations_page
 create_bugs_page
 create_dashboard_page
+stop_graph_worker
 rm -f $DUMMY_FILE >/dev/null
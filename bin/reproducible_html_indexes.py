@@ -10,25 +10,27 @@
 #
 # Build quite all index_* pages
 
+from collections import namedtuple
 from reproducible_common import *
-from sqlalchemy import select, and_, or_, func, bindparam, desc
+from sqlalchemy import select, and_, func, bindparam
 
 """
 Reference doc for the folowing lists:
 
 * queries is just a list of queries. They are referred further below.
-  + every query must return only a list of package names (excpet count_total)
+  + every query is evaluated against a SuiteArchSnapshot, which loads all the
+    packages of a suite/arch at once, and returns only a list of package names
 * pages is just a list of pages. It is actually a dictionary, where every
   element is a page. Every page has:
   + `title`: The page title
   + `header`: (optional) sane html to be printed on top of the page
-  + `header_query`: (optional): the output of this query is put inside "tot" of
-    the string above
+  + `header_count`: (optional): a function called with the SuiteArchSnapshot,
+    its output is put inside "tot" of the string above
   + `body`: a list of dicts containing every section that made up the page.
     Every section has:
     - `icon_status`: the name of a icon (see get_status_icon())
     - `icon_link`: a link to hide below the icon
-    - `query`: query to perform against the reproducible db to get the list of
+    - `query`: query to evaluate against the snapshot to get the list of
       packages to show
     - `text` a string. Template instance with $tot (total of packages listed)
       and $percent (percentage of all packages)
@@ -61,14 +63,6 @@ results = db_table('results')
 sources = db_table('sources')
 notes = db_table('notes')
 
-# filtered_issues is defined in reproducible_common.py and
-# can be used to excludes some FTBFS issues
-filter_issues_list = []
-for issue in filtered_issues:
-    filter_issues_list.append(notes.c.issues.contains(issue))
-if not filtered_issues:
-    filter_issues_list = [None]
-
 count_results = select(
     [func.count(results.c.id)]
 ).select_from(
@@ -80,237 +74,132 @@ count_results = select(
     )
 )
 
-select_sources = select(
-    [sources.c.name]
-).select_from(
-    results.join(sources)
-).where(
-    and_(
-        sources.c.suite == bindparam('suite'),
-        sources.c.architecture == bindparam('arch')
-    )
-)
+Row = namedtuple('Row', ['name', 'status', 'build_date', 'notify_maintainer',
+                         'noted', 'filtered'])
 
-queries = {
-    "count_total": count_results,
-    "count_timespan":
-        count_results.where(
-                results.c.build_date > bindparam('timespan_date'),
-        ),
-    "reproducible_all":
-        select_sources.where(
-            results.c.status == 'reproducible',
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "reproducible_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == 'reproducible',
-                results.c.build_date > timespan_date_map[24],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "reproducible_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == 'reproducible',
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "reproducible_all_abc":
-        select_sources.where(
-            results.c.status == 'reproducible',
-        ).order_by(
-            sources.c.name
-        ),
-    "FTBR_all":
-        select_sources.where(
-            results.c.status == 'unreproducible',
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBR_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == 'unreproducible',
-                results.c.build_date > timespan_date_map[24],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBR_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == 'unreproducible',
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBR_all_abc":
-        select_sources.where(
-            results.c.status == 'unreproducible',
-        ).order_by(
-            sources.c.name
-        ),
-    "FTBFS_all":
-        select_sources.where(
-            results.c.status == 'FTBFS',
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == 'FTBFS',
-                results.c.build_date > timespan_date_map[24],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == 'FTBFS',
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_all_abc":
-        select_sources.where(
-            results.c.status == 'FTBFS',
-        ).order_by(
-            sources.c.name
-        ),
-    "FTBFS_filtered":
-        select_sources.where(
-            and_(
-                results.c.status == 'FTBFS',
-                sources.c.id.notin_(
-                    select(
-                        [notes.c.package_id]
-                    ).select_from(
-                        notes
-                    ).where(
-                        or_(*filter_issues_list)
-                    )
-                )
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "FTBFS_caused_by_us":
-        select_sources.where(
-            and_(
-                results.c.status == 'FTBFS',
-                sources.c.id.in_(
-                    select(
-                        [notes.c.package_id]
-                    ).select_from(
-                        notes
-                    ).where(
-                        or_(*filter_issues_list)
-                    )
-                )
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "404_all":
-        select_sources.where(
-            results.c.status == '404',
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "404_all_abc":
-        select_sources.where(
-            results.c.status == '404',
-        ).order_by(
-            sources.c.name
-        ),
-    "depwait_all":
-        select_sources.where(
-            results.c.status == 'depwait',
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "depwait_all_abc":
-        select_sources.where(
-            results.c.status == 'depwait',
-        ).order_by(
-            sources.c.name
-        ),
-    "depwait_last24h":
-        select_sources.where(
-            and_(
-                results.c.status == 'depwait',
-                results.c.build_date > timespan_date_map[24],
 
+class SuiteArchSnapshot:
+    """
+    All the sources of a suite/arch, with their results and notes, loaded
+    with one query. Every section of every index page is derived from this,
+    instead of querying the database for each of them.
+    """
+    def __init__(self, suite, arch):
+        self.suite = suite
+        self.arch = arch
+        query = select([
+            sources.c.name,
+            results.c.status,
+            results.c.build_date,
+            sources.c.notify_maintainer,
+            notes.c.package_id,
+            notes.c.issues,
+        ]).select_from(
+            sources.outerjoin(
+                results, results.c.package_id == sources.c.id
+            ).outerjoin(
+                notes, notes.c.package_id == sources.c.id
             )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "depwait_last48h":
-        select_sources.where(
-            and_(
-                results.c.status == 'depwait',
-                results.c.build_date > timespan_date_map[48],
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "not_for_us_all":
-        select_sources.where(
-            and_(
-                results.c.status == 'not for us',
-
-            )
-        ).order_by(
-            sources.c.name
-        ),
-    "blacklisted_all":
-        select_sources.where(
-            results.c.status == 'blacklisted',
-        ).order_by(
-            sources.c.name
-        ),
-    "notes":
-        select(
-            [sources.c.name]
-        ).select_from(
-            sources.join(results).join(notes)
         ).where(
             and_(
-                results.c.status == bindparam('status'),
                 sources.c.suite == bindparam('suite'),
                 sources.c.architecture == bindparam('arch')
             )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
-    "no_notes":
-        select_sources.where(
-            and_(
-                results.c.status == bindparam('status'),
-                sources.c.id.notin_(select([notes.c.package_id]).select_from(notes))
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
+        )
+        self.rows = []
+        for name, status, build_date, notify, noted, issues in \
+                query_db(query.params({'suite': suite, 'arch': arch})):
+            # filtered_issues is defined in reproducible_common.py and
+            # can be used to excludes some FTBFS issues
+            filtered = noted is not None and \
+                any(issue in (issues or '') for issue in filtered_issues)
+            self.rows.append(Row(name, status, build_date or '', notify,
+                                 noted is not None, filtered))
+        # the packages with a result, ie. the tested ones
+        self.tested = [r for r in self.rows if r.status is not None]
+        self._cache = {}
+        log.debug('Loaded %s sources (%s tested) for %s/%s', len(self.rows),
+                  len(self.tested), suite, arch)
+
+    def count_total(self):
+        return len(self.tested)
+
+    def count_timespan(self, timespan):
+        date = timespan_date_map[timespan]
+        return len([r for r in self.tested if r.build_date > date])
+
+    def select(self, query, status=None):
+        """
+        Return the list of package names matching a query from `queries`.
+        `status` is used by the queries that don't define one themselves.
+        """
+        try:
+            return self._cache[(query, status)]
+        except KeyError:
+            pass
+        spec = queries[query]
+        status = spec.get('status', status)
+        rows = [r for r in self.tested if r.status == status]
+        if spec.get('timespan'):
+            date = timespan_date_map[spec['timespan']]
+            rows = [r for r in rows if r.build_date > date]
+        if spec.get('filter'):
+            rows = [r for r in rows if spec['filter'](r)]
+        if spec['order'] == 'date':
+            rows = sorted(rows, key=lambda r: r.build_date, reverse=True)
+        else:
+            rows = sorted(rows, key=lambda r: r.name)
+        self._cache[(query, status)] = [r.name for r in rows]
+        return self._cache[(query, status)]
+
+
+snapshots = {}
+
+
+def get_snapshot(suite, arch):
+    if (suite, arch) not in snapshots:
+        snapshots[(suite, arch)] = SuiteArchSnapshot(suite, arch)
+    return snapshots[(suite, arch)]
+
+
+# every query selects the tested packages with a given status (either fixed
+# here or taken from the section's `db_status`), optionally only those built
+# within `timespan` hours and/or matching `filter`, ordered by `order`
+# ('date': most recently built first, or 'name').
+queries = {
+    "reproducible_all": {'status': 'reproducible', 'order': 'date'},
+    "reproducible_last24h":
+        {'status': 'reproducible', 'timespan': 24, 'order': 'date'},
+    "reproducible_last48h":
+        {'status': 'reproducible', 'timespan': 48, 'order': 'date'},
+    "reproducible_all_abc": {'status': 'reproducible', 'order': 'name'},
+    "FTBR_all": {'status': 'unreproducible', 'order': 'date'},
+    "FTBR_last24h":
+        {'status': 'unreproducible', 'timespan': 24, 'order': 'date'},
+    "FTBR_last48h":
+        {'status': 'unreproducible', 'timespan': 48, 'order': 'date'},
+    "FTBR_all_abc": {'status': 'unreproducible', 'order': 'name'},
+    "FTBFS_all": {'status': 'FTBFS', 'order': 'date'},
+    "FTBFS_last24h": {'status': 'FTBFS', 'timespan': 24, 'order': 'date'},
+    "FTBFS_last48h": {'status': 'FTBFS', 'timespan': 48, 'order': 'date'},
+    "FTBFS_all_abc": {'status': 'FTBFS', 'order': 'name'},
+    "FTBFS_filtered":
+        {'status': 'FTBFS', 'filter': lambda r: not r.filtered,
+         'order': 'date'},
+    "FTBFS_caused_by_us":
+        {'status': 'FTBFS', 'filter': lambda r: r.filtered, 'order': 'date'},
+    "404_all": {'status': '404', 'order': 'date'},
+    "404_all_abc": {'status': '404', 'order': 'name'},
+    "depwait_all": {'status': 'depwait', 'order': 'date'},
+    "depwait_all_abc": {'status': 'depwait', 'order': 'name'},
+    "depwait_last24h": {'status': 'depwait', 'timespan': 24, 'order': 'date'},
+    "depwait_last48h": {'status': 'depwait', 'timespan': 48, 'order': 'date'},
+    "not_for_us_all": {'status': 'not for us', 'order': 'name'},
+    "blacklisted_all": {'status': 'blacklisted', 'order': 'name'},
+    "notes": {'filter': lambda r: r.noted, 'order': 'date'},
+    "no_notes": {'filter': lambda r: not r.noted, 'order': 'date'},
     "notification":
-        select_sources.where(
-            and_(
-                results.c.status == bindparam('status'),
-                sources.c.notify_maintainer == 1
-            )
-        ).order_by(
-            desc(results.c.build_date)
-        ),
+        {'filter': lambda r: r.notify_maintainer == 1, 'order': 'date'},
 }
 
 pages = {
@@ -523,7 +412,8 @@ pages = {
         'notes': True,
         'title': 'Packages with notes',
         'header': '<p>There are {tot} packages with notes in {suite}/{arch}.</p>',
-        'header_query': "SELECT count(*) FROM (SELECT s.name FROM sources AS s JOIN notes AS n ON n.package_id=s.id WHERE s.suite='{suite}' AND s.architecture='{arch}' GROUP BY s.name) AS tmp",
+        'header_count': lambda snapshot: len(set(
+            r.name for r in snapshot.rows if r.noted)),
         'body': [
             {
                 'icon_status': 'FTBR',
@@ -579,7 +469,9 @@ pages = {
         'notes_hint': True,
         'title': 'Packages without notes',
         'header': '<p>There are {tot} faulty packages without notes in {suite}/{arch}.{hint}</p>',
-        'header_query': "SELECT COUNT(*) FROM (SELECT s.id FROM sources AS s JOIN results AS r ON r.package_id=s.id WHERE r.status IN ('unreproducible', 'FTBFS', 'blacklisted') AND s.id NOT IN (SELECT package_id FROM notes) AND s.suite='{suite}' AND s.architecture='{arch}') AS tmp",
+        'header_count': lambda snapshot: len([
+            r for r in snapshot.tested if not r.noted and
+            r.status in ('unreproducible', 'FTBFS', 'blacklisted')]),
         'body': [
             {
                 'icon_status': 'FTBR',
@@ -610,7 +502,8 @@ pages = {
         'nosuite': True,
         'title': 'Packages with notification enabled',
         'header': '<p>The following {tot} packages have notifications enabled. (This page only shows packages in {suite}/{arch} though notifications are send for these packages in unstable and experimental in all tested architectures.) On status changes (e.g. reproducible → unreproducible) the system notifies the maintainer and relevant parties via an email to $srcpackage@packages.debian.org. Notifications are collected and send once a day to avoid flooding.<br />Please ask us to enable notifications for your package(s) in our IRC channel #debian-reproducible or via <a href="mailto:reproducible-builds@lists.alioth.debian.org">mail</a> - but ask your fellow team members first if they want to receive such notifications.</p>',
-        'header_query': "SELECT COUNT(*) FROM sources WHERE suite='{suite}' AND architecture='{arch}' AND notify_maintainer = 1",
+        'header_count': lambda snapshot: len([
+            r for r in snapshot.rows if r.notify_maintainer == 1]),
         'body': [
             {
                 'icon_status': 'FTBR',
@@ -641,10 +534,14 @@ pages = {
 }
 
 
-def build_leading_text_section(section, rows, suite, arch):
+def build_leading_text_section(section, rows, suite, arch, snapshot=None):
     html = '<p>\n' + tab
     total = len(rows)
-    count_total = int(query_db(queries['count_total'].params({'suite': suite, 'arch': arch}))[0][0])
+    if snapshot:
+        count_total = snapshot.count_total()
+    else:
+        count_total = int(query_db(count_results.params(
+            {'suite': suite, 'arch': arch}))[0][0])
     try:
         percent = round(((total/count_total)*100), 1)
     except ZeroDivisionError:
@@ -664,13 +561,11 @@ def build_leading_text_section(section, rows, suite, arch):
         html += '</a>'
     html += '\n' + tab
     if section.get('text') and section.get('timespan'):
-        count = len(query_db(queries[section['query2']].params(
-            {'suite': suite, 'arch': arch})))
+        if not snapshot:
+            snapshot = get_snapshot(suite, arch)
+        count = len(snapshot.select(section['query2']))
         percent = round(((count/count_total)*100), 1)
-        timespan = section['timespan']
-        timespan_date = timespan_date_map[timespan]
-        timespan_count = int(query_db(queries['count_timespan'].params(
-            {'suite': suite, 'arch': arch, 'timespan_date': timespan_date}))[0][0])
+        timespan_count = snapshot.count_timespan(section['timespan'])
         try:
             timespan_percent = round(((total/timespan_count)*100), 1)
         except ZeroDivisionError:
@@ -693,28 +588,22 @@ def build_leading_text_section(section, rows, suite, arch):
 
 
 def build_page_section(page, section, suite, arch):
-    try:
-        if pages[page].get('global') and pages[page]['global']:
-            suite = defaultsuite
-            arch = defaultarch
-        if pages[page].get('notes') and pages[page]['notes']:
-            query = queries[section['query']].params({
-                'status': section['db_status'], 'suite': suite, 'arch': arch})
-        else:
-            query = queries[section['query']].params({'suite': suite, 'arch': arch})
-        rows = query_db(query)
-    except:
-        print_critical_message('A query failed: %s' % query)
-        raise
+    if pages[page].get('global') and pages[page]['global']:
+        suite = defaultsuite
+        arch = defaultarch
+    snapshot = get_snapshot(suite, arch)
+    if pages[page].get('notes') and pages[page]['notes']:
+        rows = snapshot.select(section['query'], section['db_status'])
+    else:
+        rows = snapshot.select(section['query'])
     html = ''
     footnote = True if rows else False
     if not rows:                            # there are no package in this set
-        log.debug('empty query: %s' % query)  # do not output anything.
+        log.debug('empty query: %s' % section['query'])  # do not output anything.
         return (html, footnote)
-    html += build_leading_text_section(section, rows, suite, arch)
+    html += build_leading_text_section(section, rows, suite, arch, snapshot)
     html += '<p>\n' + tab + '<code>\n'
-    for row in rows:
-        pkg = row[0]
+    for pkg in rows:
         html += tab*2 + link_package(pkg, suite, arch, bugs)
     else:
         html += tab + '</code>\n'
@@ -750,9 +639,10 @@ def build_page(page, suite=None, arch=None):
             hint = ' <em>These</em> are the packages with failures that <em>still need to be investigated</em>.'
         else:
             hint = ''
-        if pages[page].get('header_query'):
+        if pages[page].get('header_count'):
             html += pages[page]['header'].format(
-                tot=query_db(pages[page]['header_query'].format(suite=suite, arch=arch))[0][0], suite=suite, arch=arch, hint=hint)
+                tot=pages[page]['header_count'](get_snapshot(suite, arch)),
+                suite=suite, arch=arch, hint=hint)
         else:
             html += pages[page].get('header')
     for section in page_sections:
@@ -801,6 +691,8 @@ if __name__ == '__main__':
             for page in pages.keys():
                 if 'global' not in pages[page] or not pages[page]['global']:
                     build_page(page, suite, arch)
+            # all the pages of this suite/arch are done, free the memory
+            snapshots.pop((suite, arch), None)
     for page in pages.keys():
         if 'global' in  pages[page] and pages[page]['global']:
             build_page(page)
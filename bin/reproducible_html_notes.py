@@ -13,7 +13,6 @@
 import copy
 import yaml
 import popcon
-import pystache
 from collections import OrderedDict
 from math import sqrt
 from reproducible_common import *
@@ -21,9 +20,7 @@ from reproducible_html_packages import gen_packages_html
 from reproducible_html_indexes import build_page
 from sqlalchemy import select, and_, bindparam
 
-renderer = pystache.Renderer()
-notes_body_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'notes_body'))
+notes_body_template = get_template('notes_body')
 
 NOTES = 'packages.yml'
 ISSUES = 'issues.yml'
@@ -351,7 +348,7 @@ def purge_old_notes(notes):
             except IndexError:  # the package is not tested. this can happen if
                 pass            # a package got removed from the archive
     if to_rebuild:
-        gen_packages_html([Package(x) for x in to_rebuild])
+        gen_packages_html(Package.load_many(to_rebuild))
 
 
 def purge_old_issues(issues):
@@ -495,7 +492,7 @@ if __name__ == '__main__':
         pass
     purge_old_notes(notes)
     purge_old_issues(issues)
-    gen_packages_html([Package(x) for x in notes])
+    gen_packages_html(Package.load_many(notes))
     for suite in SUITES:
         for arch in ARCHS:
             build_page('notes', suite, arch)
@@ -11,24 +11,18 @@
 # Build rb-pkg pages (the pages that describe the package status)
 
 from reproducible_common import *
-import pystache
 import apt_pkg
+from collections import Counter
+from functools import partial
+from multiprocessing import Pool
 apt_pkg.init_system()
 
 # Templates used for creating package pages
-renderer = pystache.Renderer();
-package_page_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_page'))
-package_navigation_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_navigation'))
-suitearch_section_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_suitearch_section'))
-suitearch_details_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_suitearch_details'))
-project_links_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'project_links'))
-package_history_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'package_history'))
+package_page_template = get_template('package_page')
+package_navigation_template = get_template('package_navigation')
+suitearch_section_template = get_template('package_suitearch_section')
+suitearch_details_template = get_template('package_suitearch_details')
+package_history_template = get_template('package_history')
 
 
 def sizeof_fmt(num):
@@ -321,18 +315,90 @@ def gen_history_page(package, arch=None):
     write_html_page(title=title, body=html, destfile=destfile,
                     noendpage=True)
 
-def gen_packages_html(packages, no_clean=False):
+def split_in_chunks(items, jobs):
+    """
+    Split items in a few chunks per worker, so that a slow chunk doesn't leave
+    the other workers idle at the end of the run.
+    """
+    size = max(1, -(-len(items) // (jobs * 4)))
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+def _run_chunk(func, chunk):
+    # workers exit without running the atexit handlers, so save the page
+    # hashes here and pass the counters of written pages and executed
+    # statements, and the SQL profile, to the parent
+    before = html_pages_stats.copy()
+    stats = func(chunk)
+    save_page_hashes()
+    for key in ('written', 'skipped'):
+        stats['html pages ' + key] = html_pages_stats[key] - before[key]
+    profile = dict(sql_profile)
+    sql_profile.clear()
+    counters = statement_counters.copy()
+    statement_counters.clear()
+    return stats, profile, counters
+
+
+def run_in_pool(func, chunks, jobs):
+    """
+    Run func() over every chunk in a pool of `jobs` worker processes, each
+    with its own database connection, and sum up the returned Counter()s.
+    """
+    stats = Counter()
+    with Pool(jobs, initializer=init_worker) as pool:
+        for chunk_stats, profile, counters in pool.imap_unordered(
+                partial(_run_chunk, func), chunks):
+            stats.update(chunk_stats)
+            merge_sql_profile(profile)
+            statement_counters.update(counters)
+    for key in ('written', 'skipped'):
+        html_pages_stats[key] += stats.pop('html pages ' + key, 0)
+    return stats
+
+
+def log_packages_stats(stats):
+    log.info('Generated %s package pages, %s diffoscope pages and %s history '
+             'pages for %s packages.', stats['package pages'],
+             stats['diffoscope pages'], stats['history pages'],
+             stats['packages'])
+
+
+def gen_packages_html(packages, no_clean=False, jobs=None):
     """
     generate the /rb-pkg/package.HTML pages.
     packages should be a list of Package objects.
+    If jobs is > 1 the pages are generated by that many worker processes.
     """
     total = len(packages)
     log.debug('Generating the pages of ' + str(total) + ' package(s)')
-    for package in sorted(packages, key=lambda x: x.name):
+    if jobs is None:
+        jobs = args.jobs
+    packages = sorted(packages, key=lambda x: x.name)
+    if jobs > 1 and total > 1:
+        stats = run_in_pool(_gen_packages_html,
+                            split_in_chunks(packages, jobs), jobs)
+    else:
+        stats = _gen_packages_html(packages)
+    log_packages_stats(stats)
+
+    if not no_clean:
+        purge_old_pages()  # housekeep is always good
+
+
+def _load_and_gen_packages_html(names):
+    return _gen_packages_html(Package.load_many(names, no_notes=True))
+
+
+def _gen_packages_html(packages):
+    stats = Counter()
+    for package in packages:
         assert isinstance(package, Package)
+        stats['packages'] += 1
         gen_history_page(package)
         for arch in ARCHS:
             gen_history_page(package, arch)
+        stats['history pages'] += 1 + len(ARCHS)
 
         pkg = package.name
 
@@ -362,7 +428,7 @@ def gen_packages_html(packages, no_clean=False):
                         'history_arch': a,
                         'history_arch_uri': '{}/{}/{}.html'.format(HISTORY_URI, a, pkg)
                     })
-                project_links = renderer.render(project_links_template)
+                project_links = render_static('project_links')
                 desturl = '{}{}/{}/{}/{}.html'.format(
                     REPRODUCIBLE_URL,
                     RB_PKG_URI,
@@ -396,6 +462,7 @@ def gen_packages_html(packages, no_clean=False):
                 write_html_page(title=title, body=body_html, destfile=destfile,
                                 no_header=True, noendpage=True,
                                 left_nav_html=navigation_html)
+                stats['package pages'] += 1
                 log.debug("Package page generated at " + desturl)
 
                 # Optionally generate a page in which the main iframe shows the
@@ -416,71 +483,108 @@ def gen_packages_html(packages, no_clean=False):
                     write_html_page(title=title, body=body_html, destfile=destfile,
                                     no_header=True, noendpage=True,
                                     left_nav_html=navigation_html)
+                    stats['diffoscope pages'] += 1
                     log.debug("Package diffoscope page generated at " + desturl)
-
-    if not no_clean:
-        purge_old_pages()  # housekeep is always good
+    return stats
 
 
-def gen_all_rb_pkg_pages(no_clean=False):
+def gen_all_rb_pkg_pages(no_clean=False, jobs=None):
     query = 'SELECT DISTINCT name FROM sources'
     rows = query_db(query)
-    pkgs = [Package(str(i[0]), no_notes=True) for i in rows]
+    names = sorted(str(i[0]) for i in rows)
     log.info('Processing all %s package from all suites/architectures',
-             len(pkgs))
-    gen_packages_html(pkgs, no_clean=True)  # we clean at the end
+             len(names))
+    if jobs is None:
+        jobs = args.jobs
+    if jobs > 1:
+        # let every worker load its own share of the packages
+        log.info('Using %s worker processes', jobs)
+        stats = run_in_pool(_load_and_gen_packages_html,
+                            split_in_chunks(names, jobs), jobs)
+        log_packages_stats(stats)
+    else:
+        pkgs = Package.load_many(names, no_notes=True)
+        gen_packages_html(pkgs, no_clean=True, jobs=1)  # we clean at the end
     purge_old_pages()
 
 
+def gen_journaled_packages_html(jobs=None):
+    """
+    Regenerate the pages of the packages listed in the rb_pkg_journal table,
+    then drop those journal entries.
+    Pages of packages no longer in a suite/arch are removed.
+    """
+    journal = db_table('rb_pkg_journal')
+    sources = db_table('sources')
+    rows = query_db(sql.select([journal.c.id, journal.c.name, journal.c.suite,
+                                journal.c.architecture]))
+    if not rows:
+        log.info('The rb-pkg journal is empty, nothing to do.')
+        return
+    ids = [x[0] for x in rows]
+    changed = set((x[1], x[2], x[3]) for x in rows)
+    names = sorted(set(x[0] for x in changed))
+    log.info('%s journal entries, for %s packages.', len(rows), len(names))
+
+    query = sql.select(
+        [sources.c.name, sources.c.suite, sources.c.architecture]
+    ).where(sources.c.name.in_(names))
+    existing = set((x[0], x[1], x[2]) for x in query_db(query))
+    for pkg, suite, arch in sorted(changed - existing):
+        for page in (os.path.join(RB_PKG_PATH, suite, arch, pkg + '.html'),
+                     os.path.join(RB_PKG_PATH, suite, arch,
+                                  'diffoscope-results', pkg + '.html')):
+            if os.access(page, os.R_OK):
+                log.info('%s is not in %s/%s anymore, removing %s', pkg,
+                         suite, arch, page)
+                os.remove(page)
+
+    names = sorted(set(x[0] for x in existing))
+    gen_packages_html(Package.load_many(names, no_notes=True), no_clean=True,
+                      jobs=jobs)
+    # only the entries read above, new ones may have been added meanwhile
+    query_db(journal.delete().where(journal.c.id.in_(ids)))
+    log.info('Dropped %s entries from the rb-pkg journal.', len(rows))
+
+
 def purge_old_pages():
-    for suite in SUITES:
-        for arch in ARCHS:
-            log.info('Removing old pages from ' + suite + '/' + arch + '.')
+    # all the rb-pkg and diffoscope-results pages are listed at once, the
+    # suite/arch directories being scanned in parallel
+    pages = scan_trees({'rb-pkg': RB_PKG_PATH}, suites=SUITES, archs=ARCHS,
+                       stat=False)['rb-pkg']
+    log.debug('page presents: ' + str(len(pages)))
+
+    # get the existing packages
+    query = "SELECT name, suite, architecture FROM sources"
+    cur_pkgs = set([(p.name, p.suite, p.architecture) for p in query_db(query)])
+
+    for page in sorted(pages, key=lambda x: x.path):
+        # When diffoscope results exist for a package, we create a page
+        # that displays the diffoscope results by default in the main iframe
+        # in the diffoscope-results subdirectory.
+        if page.subdir not in ('', 'diffoscope-results'):
+            continue
+        pkg = page.name.rsplit('.', 1)[0]
+        if (pkg, page.suite, page.arch) not in cur_pkgs:
+            where = page.suite + '/' + page.arch
+            if page.subdir:
+                where += '/' + page.subdir
+            log.info('There is no package named ' + pkg + ' from ' + where +
+                     ' in the database. Removing old page.')
             try:
-                presents = sorted(os.listdir(RB_PKG_PATH + '/' + suite + '/' +
-                                  arch))
-            except OSError as e:
-                if e.errno != errno.ENOENT:  # that's 'No such file or
-                    raise                    # directory' error (errno 17)
-                presents = []
-            log.debug('page presents: ' + str(presents))
-
-            # get the existing packages
-            query = "SELECT name, suite, architecture FROM sources " + \
-                    "WHERE suite='{}' AND architecture='{}'".format(suite, arch)
-            cur_pkgs = set([(p.name, p.suite, p.architecture) for p in query_db(query)])
-
-            for page in presents:
-                # When diffoscope results exist for a package, we create a page
-                # that displays the diffoscope results by default in the main iframe
-                # in this subdirectory. Ignore this directory.
-                if page == 'diffoscope-results':
-                    continue
-                pkg = page.rsplit('.', 1)[0]
-
-                if (pkg, suite, arch) not in cur_pkgs:
-                    log.info('There is no package named ' + pkg + ' from ' +
-                             suite + '/' + arch + ' in the database. ' +
-                             'Removing old page.')
-                    os.remove(RB_PKG_PATH + '/' + suite + '/' + arch + '/' +
-                              page)
-
-            # Additionally clean up the diffoscope results default pages
-            log.info('Removing old pages from ' + suite + '/' + arch +
-                     '/diffoscope-results/.')
-            try:
-                presents = sorted(os.listdir(RB_PKG_PATH + '/' + suite + '/' +
-                                             arch + '/diffoscope-results'))
-            except OSError as e:
-                if e.errno != errno.ENOENT:  # that's 'No such file or
-                    raise                    # directory' error (errno 17)
-                presents = []
-            log.debug('diffoscope page presents: ' + str(presents))
-            for page in presents:
-                pkg = page.rsplit('.', 1)[0]
-                if (pkg, suite, arch) not in cur_pkgs:
-                    log.info('There is no package named ' + pkg + ' from ' +
-                             suite + '/' + arch + '/diffoscope-results in ' + 
-                             'the database. Removing old page.')
-                    os.remove(RB_PKG_PATH + '/' + suite + '/' + arch + '/' +
-                              'diffoscope-results/' + page)
+                os.remove(page.path)
+            except FileNotFoundError:
+                pass  # removed in the meantime
+
+
+if __name__ == '__main__':
+    local_parser = argparse.ArgumentParser(
+        description='Generate the rb-pkg pages')
+    local_parser.add_argument('--incremental', action='store_true',
+        help='only regenerate the pages of the packages listed in the '
+             'rb_pkg_journal table')
+    local_args = local_parser.parse_known_args(unknown_args)[0]
+    if local_args.incremental:
+        gen_journaled_packages_html(jobs=args.jobs)
+    else:
+        gen_all_rb_pkg_pages(jobs=args.jobs)
@@ -7,77 +7,94 @@
 #           © 2015 Mattia Rizzolo <mattia@debian.org>
 # Licensed under GPL-2
 #
-# Depends: python3, reproducible_common, time, pystache, csv
+# Depends: python3, reproducible_common, reproducible_graphs, time, pystache, numpy
 #
 # Build rb-pkg pages (the pages that describe the package status)
 
 from reproducible_common import *
 
-import csv
 import time
-import pystache
+import numpy
 from collections import OrderedDict
+from reproducible_graphs import GraphCache, get_watermarks, render_graph
 
 # Templates used for creating package pages
-renderer = pystache.Renderer()
-pkgset_navigation_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'pkgset_navigation'))
-pkgset_details_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'pkgset_details'))
-pkg_legend_template = renderer.load_template(
-    os.path.join(TEMPLATE_PATH, 'pkg_symbol_legend'))
+pkgset_navigation_template = get_template('pkgset_navigation')
+pkgset_details_template = get_template('pkgset_details')
 
 # we only do stats up until yesterday
 YESTERDAY = (datetime.now()-timedelta(days=1)).strftime('%Y-%m-%d')
 
-def gather_meta_stats(suite, arch, pkgset_name):
-    pkgset_file = os.path.join(PKGSET_DEF_PATH, 'meta_pkgsets-' + suite,
-                               pkgset_name + '.pkgset')
-
-    try:
-        with open(pkgset_file) as f:
-            pkgset_list = [s.strip() for s in f.readlines()]
-    except FileNotFoundError:
-        log.warning('No meta package set information exists at ' + pkgset_file)
-        return {}
-
-    if not pkgset_list:
-        log.warning('No packages listed for package set: ' + pkgset_name)
-        return {}
-
-    package_where = "s.name in ('" + ("', '").join(pkgset_list) + "')"
-    root_query = """
-        SELECT s.name
+def load_pkgsets(suite):
+    """
+    Read all the package sets of `suite`, coding the package names as
+    indexes into a sorted array of all the names listed in any of them.
+    Returns (names, {pkgset_name: array of codes}); the package sets which
+    are missing or empty are left out.
+    """
+    pkgsets = {}
+    for pkgset_name, _ in META_PKGSET:
+        pkgset_file = os.path.join(PKGSET_DEF_PATH, 'meta_pkgsets-' + suite,
+                                   pkgset_name + '.pkgset')
+        try:
+            with open(pkgset_file) as f:
+                pkgset_list = [s.strip() for s in f.readlines()]
+        except FileNotFoundError:
+            log.warning('No meta package set information exists at ' + pkgset_file)
+            continue
+        if not pkgset_list:
+            log.warning('No packages listed for package set: ' + pkgset_name)
+            continue
+        pkgsets[pkgset_name] = pkgset_list
+    names = numpy.array(sorted(set(x for pkgset_list in pkgsets.values()
+                                   for x in pkgset_list)), dtype=str)
+    return names, {pkgset_name: numpy.searchsorted(names, pkgset_list)
+                   for pkgset_name, pkgset_list in pkgsets.items()}
+
+
+def load_status_table(suite, arch, names):
+    """
+    Get the status of all the packages of suite/arch built until yesterday,
+    in the order they were built, coding their names like load_pkgsets().
+    Packages not in any package set get the code -1.
+    """
+    query = """
+        SELECT s.name, r.status
         FROM results AS r
         JOIN sources AS s ON r.package_id=s.id
-        WHERE s.suite='{suite}'
-        AND s.architecture='{arch}'
-        AND date(r.build_date)<='{date}'
-        AND {package_where}
-    """.format(suite=suite, arch=arch, date=YESTERDAY,
-               package_where=package_where)
+        WHERE s.suite=:suite
+        AND s.architecture=:arch
+        AND date(r.build_date)<=:date
+        AND r.status IS NOT NULL
+        ORDER BY r.build_date, s.name
+    """
+    rows = query_db(query, {'suite': suite, 'arch': arch, 'date': YESTERDAY})
+    table = {
+        'name': numpy.array([x[0] for x in rows], dtype=str),
+        'status': numpy.array([x[1] for x in rows], dtype=str),
+    }
+    codes = numpy.searchsorted(names, table['name'])
+    known = codes < len(names)
+    known[known] = names[codes[known]] == table['name'][known]
+    table['code'] = numpy.where(known, codes, -1)
+    return table
 
+
+def gather_meta_stats(table, pkgset_codes):
+    members = numpy.isin(table['code'], pkgset_codes)
+    status = table['status']
     stats = {}
-    good = query_db(root_query + "AND r.status = 'reproducible' " +
-                    "ORDER BY s.name;")
-    stats['good'] = [t[0] for t in good]
-    stats['count_good'] = len(stats['good'])
-
-    bad = query_db(root_query + "AND r.status = 'unreproducible'" +
-                   "ORDER BY r.build_date;")
-    stats['bad'] = [t[0] for t in bad]
-    stats['count_bad'] = len(stats['bad'])
-
-    ugly = query_db(root_query + "AND r.status = 'FTBFS'" +
-                    "ORDER BY r.build_date;")
-    stats['ugly'] = [t[0] for t in ugly]
-    stats['count_ugly'] = len(stats['ugly'])
-
-    rest = query_db(root_query + "AND (r.status != 'FTBFS' AND " +
-                    "r.status != 'unreproducible' AND " +
-                    "r.status != 'reproducible') ORDER BY r.build_date;")
-    stats['rest'] = [t[0] for t in rest]
-    stats['count_rest'] = len(stats['rest'])
+    # the reproducible packages are listed by name, the others by build date
+    good = members & (status == 'reproducible')
+    stats['good'] = sorted(table['name'][good].tolist())
+    bad = members & (status == 'unreproducible')
+    stats['bad'] = table['name'][bad].tolist()
+    ugly = members & (status == 'FTBFS')
+    stats['ugly'] = table['name'][ugly].tolist()
+    rest = members & ~(good | bad | ugly)
+    stats['rest'] = table['name'][rest].tolist()
+    for cutename in ('good', 'bad', 'ugly', 'rest'):
+        stats['count_' + cutename] = len(stats[cutename])
 
     stats['count_all'] = (stats['count_good'] + stats['count_bad'] +
                          stats['count_ugly'] + stats['count_rest'])
@@ -89,16 +106,22 @@ def gather_meta_stats(suite, arch, pkgset_name):
     return stats
 
 
-def update_stats(suite, arch, stats, pkgset_name):
+def get_recorded_stats(suite, arch):
+    """
+    Return the package sets which already have their stats of yesterday.
+    """
     result = query_db("""
-            SELECT datum, meta_pkg, suite
+            SELECT meta_pkg
             FROM stats_meta_pkg_state
-            WHERE datum = '{date}' AND suite = '{suite}'
-            AND architecture = '{arch}' AND meta_pkg = '{name}'
-        """.format(date=YESTERDAY, suite=suite, arch=arch, name=pkgset_name))
+            WHERE datum = :date AND suite = :suite
+            AND architecture = :arch
+        """, {'date': YESTERDAY, 'suite': suite, 'arch': arch})
+    return set(x[0] for x in result)
+
 
+def update_stats(suite, arch, stats, pkgset_name, recorded):
     # if there is not a result for this day, add one
-    if not result:
+    if pkgset_name not in recorded:
         insert = "INSERT INTO stats_meta_pkg_state VALUES ('{date}', " + \
                  "'{suite}', '{arch}', '{pkgset_name}', '{count_good}', " + \
                  "'{count_bad}', '{count_ugly}', '{count_rest}')"
@@ -185,7 +208,8 @@ def stats_thumb_file_href(suite, arch, pkgset_name):
     )
 
 
-def create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name):
+def create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name,
+                                  watermarks):
     html_body = ""
     html_body += create_pkgset_navigation(suite, arch, pkgset_name)
     pkgset_context = ({
@@ -193,18 +217,19 @@ def create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name):
         'suite': suite,
         'arch': arch,
         'pkg_symbol_legend_html':
-            renderer.render(pkg_legend_template, {}),
+            render_static('pkg_symbol_legend'),
     })
 
     png_file, png_href = stats_png_file_href(suite, arch, pkgset_name)
     thumb_file, thumb_href = stats_thumb_file_href(suite, arch, pkgset_name)
-    yesterday_timestamp = (datetime.now()-timedelta(days=1)).timestamp()
 
-    if ( not os.access(png_file, os.R_OK) or
-         os.stat(png_file).st_mtime < yesterday_timestamp ):
-        create_pkgset_graph(png_file, suite, arch, pkgset_name)
-        check_call(['convert', png_file, '-adaptive-resize', '160x80',
-                    thumb_file])
+    # only render the graph again if its series changed
+    where = pkgset_graph_where(suite, arch)
+    key = ['stats_meta_pkg_state', where, pkgset_name] + \
+        watermarks.get(pkgset_name, [None, 0])
+    if not graph_cache.is_fresh(png_file, key, thumb_file):
+        create_pkgset_graph(png_file, thumb_file, suite, arch, pkgset_name)
+        graph_cache.update(png_file, key)
 
     pkgset_context['png'] = png_href
     other_archs = [a for a in ARCHS if a != arch]
@@ -262,45 +287,57 @@ def create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name):
                     left_nav_html=left_nav_html)
 
 
-def create_pkgset_graph(png_file, suite, arch, pkgset_name):
-    table = "stats_meta_pkg_state"
-    columns = ["datum", "reproducible", "unreproducible", "FTBFS", "other"]
-    where = "WHERE suite = '%s' AND architecture = '%s' AND meta_pkg = '%s'" % \
-            (suite, arch, pkgset_name)
+def pkgset_graph_where(suite, arch):
+    where = "WHERE suite = '%s' AND architecture = '%s'" % (suite, arch)
     if arch == 'i386':
         # i386 only has pkg sets since later to make nicer graphs
         # (date added in commit 7f2525f7)
         where += " AND datum >= '2016-05-06'"
+    return where
+
+
+def create_pkgset_graph(png_file, thumb_file, suite, arch, pkgset_name):
+    table = "stats_meta_pkg_state"
+    columns = ["datum", "reproducible", "unreproducible", "FTBFS", "other"]
+    where = pkgset_graph_where(suite, arch) + \
+            " AND meta_pkg = '%s'" % pkgset_name
     query = "SELECT {fields} FROM {table} {where} ORDER BY datum".format(
         fields=", ".join(columns), table=table, where=where)
     result = query_db(query)
-    result_rearranged = [dict(zip(columns, row)) for row in result]
 
-    with create_temp_file(mode='w') as f:
-        csv_tmp_file = f.name
-        csv_writer = csv.DictWriter(f, columns)
-        csv_writer.writeheader()
-        csv_writer.writerows(result_rearranged)
-        f.flush()
-
-        graph_command = os.path.join(BIN_PATH, "make_graph.py")
-        main_label = "Reproducibility status for packages in " + suite + \
-                     " from " + pkgset_name
-        y_label = "Amount (" + pkgset_name + " packages)"
-        log.info("Creating graph for meta pkgset %s in %s/%s.",
-                  pkgset_name, suite, arch)
-        check_call([graph_command, csv_tmp_file, png_file, '4', main_label,
-                    y_label, '1920', '960'])
+    main_label = "Reproducibility status for packages in " + suite + \
+                 " from " + pkgset_name
+    y_label = "Amount (" + pkgset_name + " packages)"
+    log.info("Creating graph for meta pkgset %s in %s/%s.",
+              pkgset_name, suite, arch)
+    render_graph(result, columns[1:], png_file, 4, main_label, y_label,
+                 1920, 960, thumb_file=thumb_file)
 
 
 bugs = get_bugs()
+graph_cache = GraphCache('pkg_sets')
+# the package sets only depend on the suite, load them once for all the archs
+pkgsets = {suite: load_pkgsets(suite) for suite in SUITES
+           if suite != 'experimental'}
 for arch in ARCHS:
     for suite in SUITES:
         if suite == 'experimental':
             continue
         create_index_page(suite, arch)
+        table = load_status_table(suite, arch, pkgsets[suite][0])
+        recorded = get_recorded_stats(suite, arch)
+        all_stats = OrderedDict()
         for pkgset_name, _ in META_PKGSET:
-            stats = gather_meta_stats(suite, arch, pkgset_name)
-            if (stats):
-                update_stats(suite, arch, stats, pkgset_name)
-                create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name)
+            if pkgset_name not in pkgsets[suite][1]:
+                continue
+            stats = gather_meta_stats(table, pkgsets[suite][1][pkgset_name])
+            update_stats(suite, arch, stats, pkgset_name, recorded)
+            all_stats[pkgset_name] = stats
+        # after update_stats(), so that yesterday's stats are accounted for
+        watermarks = get_watermarks('stats_meta_pkg_state',
+                                    pkgset_graph_where(suite, arch),
+                                    group_by='meta_pkg')
+        for pkgset_name, stats in all_stats.items():
+            create_pkgset_page_and_graphs(suite, arch, stats, pkgset_name,
+                                          watermarks)
+graph_cache.save()
@@ -9,120 +9,362 @@
 # Depends: python3
 #
 # Build the reproducible.json and reproducibe-tracker.json files, to provide nice datasources
+# (plus one reproducible-tracker-$suite.json for every suite), and the deltas
+# between two exports, listed in reproducible-manifest.json
 
 from reproducible_common import *
 
 from apt_pkg import version_compare
 import aptsources.sourceslist
+import bz2
+import gzip
 import json
+import lzma
 import os
-import subprocess
 import tempfile
 
 
-output = []
-output4tracker = []
+class JSONStreamWriter:
+    """
+    Write a JSON list one item at a time, to `target` and at the same time
+    to its compressed variants (target.bz2, target.gz, target.xz), so that
+    neither the whole list nor the whole output is ever kept in memory.
+    Every file is written to a temporary file first and only renamed to
+    its final name by close().
+    """
+    compressors = {
+        'bz2': lambda f: bz2.BZ2File(f, 'wb', compresslevel=9),
+        'gz': lambda f: gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9),
+        'xz': lambda f: lzma.LZMAFile(f, 'wb'),
+    }
+
+    def __init__(self, target, compact=False):
+        self.target = target
+        self.compact = compact
+        self.count = 0
+        self.files = []  # (final name, temporary file, stream to write to)
+        for ext in [None] + sorted(self.compressors):
+            name = target if ext is None else target + '.' + ext
+            tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(name),
+                                              delete=False)
+            stream = tmp if ext is None else self.compressors[ext](tmp)
+            self.files.append((name, tmp, stream))
+        self._write('[')
+
+    def _write(self, data):
+        data = data.encode('utf-8')
+        for name, tmp, stream in self.files:
+            stream.write(data)
+
+    def write(self, item):
+        if self.compact:
+            data = json.dumps(item, sort_keys=True, separators=(',', ':'))
+            self._write((',' if self.count else '') + data)
+        else:
+            # the same output as json.dump() of the whole list with indent=4
+            data = json.dumps(item, indent=4, sort_keys=True)
+            data = '\n'.join('    ' + x for x in data.splitlines())
+            self._write((',\n' if self.count else '\n') + data)
+        self.count += 1
+
+    def close(self):
+        self._write('\n]' if self.count and not self.compact else ']')
+        for name, tmp, stream in self.files:
+            if stream is not tmp:
+                stream.close()
+            tmp.close()
+            os.rename(tmp.name, name)
+            os.chmod(name, 0o644)
+            log.info("%s/%s has been updated.", DEBIAN_URL,
+                     os.path.basename(name))
+
+
+def iter_results(query, itersize=10000):
+    """
+    Iterate over the rows of `query` with a server-side cursor, so that only
+    `itersize` rows at a time are fetched from the database.
+    """
+    cursor = conn_db.connection.cursor(name='reproducible_json')
+    cursor.itersize = itersize
+    cursor.execute(query)
+    try:
+        yield from cursor
+    finally:
+        cursor.close()
+
 
 log.info('Creating json dump of current reproducible status')
 
-# filter_query is defined in reproducible_common.py and excludes some FTBFS issues
+# filter_query is defined in reproducible_common.py and excludes some FTBFS issues.
+# The rows are sorted by the database (COLLATE "C" sorts like python does),
+# so they can be written out while they are fetched.
 query = "SELECT s.name, r.version, s.suite, s.architecture, r.status, r.build_date " + \
         "FROM results AS r JOIN sources AS s ON r.package_id = s.id "+ \
         "WHERE status != '' AND status NOT IN ('not for us', '404', 'blacklisted' ) AND (( status != 'FTBFS' ) OR " \
-        " ( status = 'FTBFS' and r.package_id NOT IN (SELECT n.package_id FROM NOTES AS n WHERE " + filter_query + " )))"
-
-result = sorted(query_db(query))
-log.info('\tprocessing ' + str(len(result)))
+        " ( status = 'FTBFS' and r.package_id NOT IN (SELECT n.package_id FROM NOTES AS n WHERE " + filter_query + " ))) " + \
+        'ORDER BY s.name COLLATE "C", r.version COLLATE "C", s.suite COLLATE "C", ' + \
+        's.architecture COLLATE "C", r.status COLLATE "C", r.build_date COLLATE "C"'
 
 keys = ['package', 'version', 'suite', 'architecture', 'status', 'build_date']
 crossarchkeys = ['package', 'version', 'suite', 'status']
 archdetailkeys = ['architecture', 'version', 'status', 'build_date']
 
-# crossarch is a dictionary of all packages used to build a summary of the
-# package's test results across all archs (for suite=unstable only)
-crossarch = {}
+# the suite tracker.d.o looks at, its summary is also written to
+# REPRODUCIBLE_TRACKER_JSON, where it always has been
+TRACKER_SUITE = 'buster'
+
+# The cross-arch status of a package is the "worst" status among the results
+# of its most recent version, in this order (from the best to the worst):
+#   depwait < reproducible < unreproducible < FTBFS
+# any other status counts as depwait.
+STATUS_LATTICE = ['depwait', 'reproducible', 'unreproducible', 'FTBFS']
+
+
+def merge_status(status1, status2):
+    rank = lambda status: STATUS_LATTICE.index(status) \
+        if status in STATUS_LATTICE else 0
+    return STATUS_LATTICE[max(rank(status1), rank(status2))]
+
+
+class CrossArchSummary:
+    """
+    Reduce the results of a package in a suite to its cross-arch summary.
+    The results only need to be fed grouped by package, as they come from
+    the query: the summary is reset whenever a newer version shows up and
+    the results of older versions are simply ignored.
+    """
+    def __init__(self, pkg):
+        self.reset(pkg)
+
+    def reset(self, pkg):
+        self.summary = {key: pkg[key] for key in crossarchkeys}
+        self.summary['architecture_details'] = \
+            [{key: pkg[key] for key in archdetailkeys}]
+
+    def add(self, pkg):
+        versionscompared = version_compare(self.summary['version'],
+                                           pkg['version'])
+        if versionscompared > 0:
+            return
+        if versionscompared < 0:
+            self.reset(pkg)
+            return
+        self.summary['status'] = merge_status(self.summary['status'],
+                                              pkg['status'])
+        self.summary['architecture_details'].append(
+            {key: pkg[key] for key in archdetailkeys})
+
+
+# how many delta files are kept around, older ones are listed in the manifest
+# no more: consumers that old need to download a full snapshot again
+DELTA_RETENTION = 48
+
+
+class ResultsDelta:
+    """
+    Compute which results changed since the previous export, comparing the
+    stream of results against the state saved by the previous run.
+    Both are sorted by package, so they are merged one package at a time.
 
-crossarchversions = {}
-for row in result:
+    The delta is a list of the new or changed results, in the same format
+    as reproducible.json, plus an entry with "removed": true for every
+    result that is gone since the previous export.
+    """
+    statekeys = ['package', 'suite', 'architecture', 'version', 'status',
+                 'build_date']
+
+    def __init__(self, target):
+        self.target = target
+        self.previous = self._read_state()
+        self.next_previous = next(self.previous, None)
+        self.changed = 0
+        self.removed = 0
+        self.max_build_date = ''
+        self.writer = JSONStreamWriter(target, compact=True) \
+            if self.next_previous else None
+        self.state = NamedTemporaryFile(
+            mode='w', dir=os.path.dirname(REPRODUCIBLE_JSON_STATE),
+            delete=False)
+
+    def _read_state(self):
+        """
+        Yield (package, {(suite, architecture): result}) from the saved state.
+        """
+        try:
+            fd = open(REPRODUCIBLE_JSON_STATE)
+        except FileNotFoundError:
+            log.info('No previous state in %s, not writing a delta.',
+                     REPRODUCIBLE_JSON_STATE)
+            return
+        with fd:
+            current, results = None, {}
+            for line in fd:
+                pkg = dict(zip(self.statekeys, line.rstrip('\n').split('\t')))
+                if pkg['package'] != current:
+                    if results:
+                        yield current, results
+                    current, results = pkg['package'], {}
+                results[(pkg['suite'], pkg['architecture'])] = pkg
+            if results:
+                yield current, results
+
+    def _removed(self, results):
+        for suite, arch in sorted(results):
+            self.writer.write({'package': results[(suite, arch)]['package'],
+                               'suite': suite, 'architecture': arch,
+                               'removed': True})
+            self.removed += 1
+
+    def add(self, package, pkgs):
+        """
+        Add all the results of `package`, in the same order as the previous
+        calls, ie. sorted by package name.
+        """
+        for pkg in pkgs:
+            self.state.write('\t'.join(str(pkg[key]) for key in self.statekeys)
+                             + '\n')
+            if pkg['build_date']:
+                self.max_build_date = max(self.max_build_date,
+                                          str(pkg['build_date']))
+        if not self.writer:
+            return
+        while self.next_previous and self.next_previous[0] < package:
+            self._removed(self.next_previous[1])
+            self.next_previous = next(self.previous, None)
+        previous = {}
+        if self.next_previous and self.next_previous[0] == package:
+            previous = self.next_previous[1]
+            self.next_previous = next(self.previous, None)
+        for pkg in pkgs:
+            old = previous.pop((pkg['suite'], pkg['architecture']), None)
+            if old is None or any(old[key] != str(pkg[key]) for key in
+                                  ('version', 'status', 'build_date')):
+                self.writer.write(pkg)
+                self.changed += 1
+        self._removed(previous)
+
+    def close(self):
+        """
+        Save the new state, and return whether a delta has been written.
+        """
+        if self.writer:
+            while self.next_previous:
+                self._removed(self.next_previous[1])
+                self.next_previous = next(self.previous, None)
+            self.writer.close()
+        self.state.close()
+        os.rename(self.state.name, REPRODUCIBLE_JSON_STATE)
+        return self.writer is not None
+
+
+def update_manifest(delta):
+    """
+    Record the new snapshot generation (and its delta, if any) in the
+    manifest, dropping the delta files past DELTA_RETENTION.
+    """
+    try:
+        with open(REPRODUCIBLE_JSON_MANIFEST) as fd:
+            manifest = json.load(fd)
+    except (OSError, ValueError):
+        manifest = {'generation': 0, 'deltas': []}
+    previous = manifest.get('snapshot', {})
+    generation = manifest['generation'] + 1
+    deltas = manifest['deltas']
+    if delta.writer:
+        deltas.append({
+            'generation': generation,
+            'since_generation': previous.get('generation'),
+            'since_build_date': previous.get('max_build_date'),
+            'until_build_date': delta.max_build_date,
+            'date': datetime.now().strftime('%Y-%m-%d %H:%M'),
+            'file': os.path.basename(delta.target),
+            'changed': delta.changed,
+            'removed': delta.removed,
+        })
+    for old in deltas[:-DELTA_RETENTION]:
+        for ext in ('', '.bz2', '.gz', '.xz'):
+            try:
+                os.remove(os.path.join(REPRODUCIBLE_JSON_DELTAS,
+                                       old['file'] + ext))
+            except FileNotFoundError:
+                pass
+    manifest = {
+        'generation': generation,
+        'snapshot': {
+            'generation': generation,
+            'date': datetime.now().strftime('%Y-%m-%d %H:%M'),
+            'max_build_date': delta.max_build_date,
+            'files': [os.path.basename(x) for x in
+                      (REPRODUCIBLE_JSON, REPRODUCIBLE_COMPACT_JSON,
+                       REPRODUCIBLE_TRACKER_JSON)],
+        },
+        'deltas': deltas[-DELTA_RETENTION:],
+    }
+    tmpfile = tempfile.mkstemp(dir=os.path.dirname(REPRODUCIBLE_JSON_MANIFEST))[1]
+    with open(tmpfile, 'w') as fd:
+        json.dump(manifest, fd, indent=4, sort_keys=True)
+    os.rename(tmpfile, REPRODUCIBLE_JSON_MANIFEST)
+    os.chmod(REPRODUCIBLE_JSON_MANIFEST, 0o644)
+    log.info("%s/%s has been updated (generation %s).", DEBIAN_URL,
+             os.path.basename(REPRODUCIBLE_JSON_MANIFEST), generation)
+
+
+def tracker_json(suite):
+    return BASE + '/reproducible-tracker-' + suite + '.json'
+
+
+output = JSONStreamWriter(REPRODUCIBLE_JSON)
+compact_output = JSONStreamWriter(REPRODUCIBLE_COMPACT_JSON, compact=True)
+# json for tracker.d.o, thanks to #785531, plus one file for every suite
+tracker_outputs = {suite: [JSONStreamWriter(tracker_json(suite))]
+                   for suite in SUITES}
+tracker_outputs[TRACKER_SUITE].append(
+    JSONStreamWriter(REPRODUCIBLE_TRACKER_JSON))
+# the results changed since the previous export
+os.makedirs(REPRODUCIBLE_JSON_DELTAS, exist_ok=True)
+delta = ResultsDelta(os.path.join(
+    REPRODUCIBLE_JSON_DELTAS,
+    'reproducible-delta-' + datetime.now().strftime('%Y%m%d%H%M%S') + '.json'))
+
+
+def write_summaries(summaries):
+    for suite, summary in sorted(summaries.items()):
+        for writer in tracker_outputs.get(suite, []):
+            writer.write(summary.summary)
+
+
+# the rows are sorted by package, so the summaries of a package are written
+# out as soon as the next package starts
+current_package = None
+summaries = {}
+pkgs = []
+for row in iter_results(query):
     pkg = dict(zip(keys, row))
     log.debug(pkg)
-    output.append(pkg)
-
-    # tracker.d.o should only care about results in testing
-    if pkg['suite'] == 'buster':
-
-        package = pkg['package']
-        if package in crossarch:
-            # compare statuses to get cross-arch package status
-            status1 = crossarch[package]['status']
-            status2 = pkg['status']
-            newstatus = ''
-
-            # compare the versions (only keep most up to date!)
-            version1 = crossarch[package]['version']
-            version2 = pkg['version']
-            versionscompared = version_compare(version1, version2);
-
-            # if version1 > version2,
-            # skip the package results we are currently inspecting
-            if (versionscompared > 0):
-                continue
-
-            # if version1 < version2,
-            # delete the package results with the older version
-            elif (versionscompared < 0):
-                newstatus = status2
-                # remove the old package information from the list
-                archlist = crossarch[package]['architecture_details']
-                newarchlist = [a for a in archlist if a['version'] != version1]
-                crossarch[package]['architecture_details'] = newarchlist
-
-            # if version1 == version 2,
-            # we are comparing status for the same (most recent) version
-            else:
-                if 'FTBFS' in [status1, status2]:
-                    newstatus = 'FTBFS'
-                elif 'unreproducible' in [status1, status2]:
-                    newstatus = 'unreproducible'
-                elif 'reproducible' in [status1, status2]:
-                    newstatus = 'reproducible'
-                else:
-                    newstatus = 'depwait'
-
-            # update the crossarch status and version
-            crossarch[package]['status'] = newstatus
-            crossarch[package]['version'] = version2
-
-            # add arch specific test results to architecture_details list
-            newarchdetails = {key:pkg[key] for key in archdetailkeys}
-            crossarch[package]['architecture_details'].append(newarchdetails)
+    output.write(pkg)
+    compact_output.write(pkg)
 
+    if pkg['package'] != current_package:
+        write_summaries(summaries)
+        if pkgs:
+            delta.add(current_package, pkgs)
+        current_package = pkg['package']
+        summaries = {}
+        pkgs = []
+    pkgs.append(pkg)
+    if pkg['suite'] in summaries:
+        summaries[pkg['suite']].add(pkg)
+    else:
+        summaries[pkg['suite']] = CrossArchSummary(pkg)
+write_summaries(summaries)
+if pkgs:
+    delta.add(current_package, pkgs)
 
-        else:
-            # add package to crossarch
-            crossarch[package] = {key:pkg[key] for key in crossarchkeys}
-            crossarch[package]['architecture_details'] = \
-                [{key:pkg[key] for key in archdetailkeys}]
-
-output4tracker = list(crossarch.values())
-
-for data, target in (
-    (output, REPRODUCIBLE_JSON),
-    # json for tracker.d.o, thanks to #785531
-    (output4tracker, REPRODUCIBLE_TRACKER_JSON),
-):
-    tmpfile = tempfile.mkstemp(dir=os.path.dirname(target))[1]
-    with open(tmpfile, 'w') as fd:
-        json.dump(data, fd, indent=4, sort_keys=True)
-    os.rename(tmpfile, target)
-    os.chmod(target, 0o644)
-    log.info("%s/%s has been updated.", DEBIAN_URL, os.path.dirname(target))
-
-    # Write compressed version
-    compressed = '{}.bz2'.format(target)
-    tmpfile = tempfile.mkstemp(dir=os.path.dirname(compressed))[1]
-    with open(tmpfile, 'w') as fd:
-        subprocess.check_call(('bzip2', '-9c', target), stdout=fd)
-    os.rename(tmpfile, compressed)
-    os.chmod(compressed, 0o644)
-    log.info("%s/%s has been updated.", DEBIAN_URL, os.path.dirname(compressed))
+log.info('\tprocessed ' + str(output.count))
+for writer in [output, compact_output] + \
+        [w for suite in SUITES for w in tracker_outputs[suite]]:
+    writer.close()
+if delta.close():
+    log.info('\t%s changed and %s removed results since the previous export',
+             delta.changed, delta.removed)
+update_manifest(delta)
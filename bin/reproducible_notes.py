@@ -147,8 +147,14 @@ def store_issues():
 
 
 def store_notes():
-    log.debug('Removing all notes')
     notes_table = db_table('notes')
+    # remember the current notes, to know which packages changed
+    query = sql.select([notes_table.c.package_id, notes_table.c.version,
+                        notes_table.c.issues, notes_table.c.bugs,
+                        notes_table.c.comments])
+    old_notes = {x[0]: tuple(str(y) for y in x[1:])
+                 for x in conn_db.execute(query)}
+    log.debug('Removing all notes')
     conn_db.execute(notes_table.delete())
     to_insert = []
     for entry in [x for y in sorted(notes) for x in notes[y]]:
@@ -169,6 +175,16 @@ def store_notes():
         conn_db.execute(notes_table.insert(), to_insert)
         log.info('Saved ' + str(len(to_insert)) + ' notes in the database')
 
+    new_notes = {x['package_id']: tuple(str(x[y]) for y in
+                    ('version', 'issues', 'bugs', 'comments'))
+                 for x in to_insert}
+    changed = set(old_notes.keys()) ^ set(new_notes.keys())
+    changed.update(x for x in new_notes
+                   if x in old_notes and old_notes[x] != new_notes[x])
+    log.info('The notes of %s packages changed', len(changed))
+    journal_package_ids(changed)
+    invalidate_notes_index()
+
 
 if __name__ == '__main__':
     notes = load_notes()
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Depends: python3 python3-numpy
+#
+# Write a columnar snapshot of results+sources+notes, for the report
+# generators that can do with slightly old data instead of querying the
+# database. Load it with load_results_snapshot() from reproducible_common.
+#
+# The snapshot is a directory holding one .npy file per column (plus a
+# .dict.npy with the sorted dictionary of each string column) and a
+# meta.json describing them. Every snapshot is written in a new directory,
+# then the "current" symlink is atomically switched to it.
+
+import shutil
+
+import numpy
+
+from reproducible_common import *
+
+
+# column name, kind, SQL expression
+COLUMNS = [
+    ('package_id', 'int32', 's.id'),
+    ('name', 'dict', 's.name'),
+    ('suite', 'dict', 's.suite'),
+    ('architecture', 'dict', 's.architecture'),
+    ('source_version', 'dict', 's.version'),
+    ('notify_maintainer', 'bool', 's.notify_maintainer != 0'),
+    ('version', 'dict', 'r.version'),
+    ('status', 'dict', 'r.status'),
+    ('build_date', 'datetime64[m]', 'r.build_date'),
+    ('build_duration', 'int32', 'r.build_duration'),
+    ('node1', 'dict', 'r.node1'),
+    ('node2', 'dict', 'r.node2'),
+    ('noted', 'bool', 'n.package_id IS NOT NULL'),
+    ('note_version', 'dict', 'n.version'),
+    ('issues', 'dict', 'n.issues'),
+    # whether the FTBFS are filtered out because of filtered_issues
+    ('filtered', 'bool', 'COALESCE((' + (filter_query or 'FALSE') + '), FALSE)'),
+]
+
+# how many old snapshots are kept, for readers still using them
+KEEP = 2
+
+
+def encode(kind, values):
+    """
+    Return the numpy array of a column, and its dictionary (or None).
+    """
+    if kind == 'dict':
+        dictionary = sorted(set(x for x in values if x is not None))
+        codes = {value: code for code, value in enumerate(dictionary)}
+        array = numpy.array([-1 if x is None else codes[x] for x in values],
+                            dtype='int32')
+        return array, numpy.array(dictionary, dtype=str)
+    if kind == 'bool':
+        return numpy.array([bool(x) for x in values], dtype=bool), None
+    if kind == 'int32':
+        return numpy.array([int(x or 0) for x in values], dtype='int32'), None
+    # datetime64: the dates are stored as 'YYYY-MM-DD HH:MM' text
+    return numpy.array(['NaT' if not x else x.replace(' ', 'T')
+                        for x in values], dtype=kind), None
+
+
+def write_snapshot(path=RESULTS_SNAPSHOT_PATH):
+    query = 'SELECT ' + ', '.join(x[2] for x in COLUMNS) + ' ' + \
+            'FROM sources AS s ' + \
+            'LEFT JOIN results AS r ON r.package_id=s.id ' + \
+            'LEFT JOIN notes AS n ON n.package_id=s.id ' + \
+            'ORDER BY s.suite, s.architecture, s.name'
+    rows = query_db(query)
+    log.info('Got %s rows from the database.', len(rows))
+    now = datetime.now()
+    destdir = os.path.join(path, now.strftime('%Y%m%d%H%M%S'))
+    os.makedirs(destdir)
+    for i, (column, kind, _) in enumerate(COLUMNS):
+        array, dictionary = encode(kind, [row[i] for row in rows])
+        numpy.save(os.path.join(destdir, column + '.npy'), array)
+        if dictionary is not None:
+            numpy.save(os.path.join(destdir, column + '.dict.npy'), dictionary)
+    meta = {
+        'date': now.strftime('%Y-%m-%d %H:%M'),
+        'rows': len(rows),
+        'columns': {column: kind for column, kind, _ in COLUMNS},
+    }
+    with open(os.path.join(destdir, 'meta.json'), 'w') as fd:
+        json.dump(meta, fd, indent=4, sort_keys=True)
+    # switch the symlink atomically, readers get either snapshot
+    tmplink = os.path.join(path, 'current.new')
+    if os.path.lexists(tmplink):
+        os.remove(tmplink)
+    os.symlink(os.path.basename(destdir), tmplink)
+    os.rename(tmplink, os.path.join(path, 'current'))
+    log.info('Results snapshot written to %s.', destdir)
+    # the snapshots are named after their date, so they sort by age
+    old = sorted(x for x in os.listdir(path) if x.isdigit())[:-KEEP]
+    for snapshot in old:
+        log.info('Removing the old snapshot %s.', snapshot)
+        shutil.rmtree(os.path.join(path, snapshot))
+
+
+if __name__ == '__main__':
+    write_snapshot()
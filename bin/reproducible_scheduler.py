@@ -10,20 +10,20 @@
 #
 # Schedule packages to be build.
 
+import io
 import sys
-import lzma
-import deb822
+import time
+import random
 import aptsources.sourceslist
 import smtplib
 from subprocess import call
+from collections import namedtuple
 from apt_pkg import version_compare
-from urllib.request import urlopen
-from sqlalchemy import sql
 from email.mime.text import MIMEText
 
 from reproducible_common import *
+from reproducible_sources import get_sources
 from reproducible_html_live_status import generate_schedule
-from reproducible_html_packages import gen_packages_html
 from reproducible_html_packages import purge_old_pages
 
 """
@@ -251,12 +251,8 @@ class Limit:
 
 
 def update_sources(suite):
-    # download the sources file for this suite
-    mirror = 'http://deb.debian.org/debian'
-    remotefile = mirror + '/dists/' + suite + '/main/source/Sources.xz'
-    log.info('Downloading sources file for %s: %s', suite, remotefile)
-    sources = lzma.decompress(urlopen(remotefile).read()).decode('utf8')
-    log.debug('\tdownloaded')
+    # the sources file of this suite is fetched (and parsed) only if changed
+    sources = get_sources(suite)
     for arch in ARCHS:
         log.info('Updating sources db for %s/%s...', suite, arch)
         update_sources_db(suite, arch, sources)
@@ -264,124 +260,104 @@ def update_sources(suite):
 
 
 def update_sources_db(suite, arch, sources):
-    # extract relevant info (package name and version) from the sources file
-    new_pkgs = set()
+    # `sources` is the list of Source returned by get_sources()
     newest_version = {}
-    for src in deb822.Sources.iter_paragraphs(sources.split('\n')):
-        pkg = (src['Package'], src['Version'], suite, arch)
-
-        if 'Extra-Source-Only' in src and src['Extra-Source-Only'] == 'yes':
-            log.debug('Ignoring {} due to Extra-Source-Only'.format(pkg))
+    for src in sources:
+        if src.extra_source_only:
+            log.debug('Ignoring {} due to Extra-Source-Only'.format(
+                (src.name, src.version, suite, arch)))
             continue
-
         # only keep the most recent version of a src for each package/suite/arch
-        key = src['Package'] + suite + arch
-        if key in newest_version:
-            oldversion = newest_version[key]
-            oldpackage = (src['Package'], oldversion, suite, arch)
-            new_pkgs.remove(oldpackage)
-
-        newest_version[key] = src['Version']
-        new_pkgs.add(pkg)
-
-    # get the current packages in the database
-    query = "SELECT name, version, suite, architecture FROM sources " + \
-            "WHERE suite='{}' AND architecture='{}'".format(suite, arch)
-    cur_pkgs = set([(p.name, p.version, p.suite, p.architecture) for p in query_db(query)])
-    pkgs_to_add = []
-    updated_pkgs = []
-    different_pkgs = [x for x in new_pkgs if x not in cur_pkgs]
-    log.debug('Packages different in the archive and in the db: %s',
-              different_pkgs)
-    for pkg in different_pkgs:
-        # pkg: (name, version, suite, arch)
-        query = "SELECT id, version, notify_maintainer FROM sources " + \
-                "WHERE name='{}' AND suite='{}' AND architecture='{}'"
-        query = query.format(pkg[0], pkg[2], pkg[3])
-        try:
-            result = query_db(query)[0]
-        except IndexError:  # new package
-            pkgs_to_add.append({
-                'name': pkg[0],
-                'version': pkg[1],
-                'suite': pkg[2],
-                'architecture': pkg[3],
-            })
-            continue
-        pkg_id = result[0]
-        old_version = result[1]
-        notify_maint = int(result[2])
-        if version_compare(pkg[1], old_version) > 0:
-            log.debug('New version: ' + str(pkg) + ' (we had  ' +
-                      old_version + ')')
-            updated_pkgs.append({
-                'update_id': pkg_id,
-                'name': pkg[0],
-                'version': pkg[1],
-                'suite': pkg[2],
-                'architecture': pkg[3],
-                'notify_maintainer': notify_maint,
-            })
-    # Now actually update the database:
-    sources_table = db_table('sources')
-    # updated packages
-    log.info('Pushing ' + str(len(updated_pkgs)) +
-             ' updated packages to the database...')
-    if updated_pkgs:
-        transaction = conn_db.begin()
-        update_query = sources_table.update().\
-                       where(sources_table.c.id == sql.bindparam('update_id'))
-        conn_db.execute(update_query, updated_pkgs)
-        transaction.commit()
+        newest_version[src.name] = src.version
+    new_pkgs = set((name, version, suite, arch) for name, version
+                   in newest_version.items())
+
+    # The whole sync is done set-based, in a single transaction: the new
+    # Sources are COPYed into a temporary table and diffed against the
+    # sources table with a few statements.
+    timings = []
+    start = time.time()
+    transaction = conn_db.begin()
+    cursor = conn_db.connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE new_sources '
+                   '(name TEXT NOT NULL, version TEXT NOT NULL) '
+                   'ON COMMIT DROP')
+    snapshot = io.StringIO(''.join('{}\t{}\n'.format(name, version)
+                           for name, version in newest_version.items()))
+    cursor.copy_from(snapshot, 'new_sources', columns=('name', 'version'))
+    timings.append(('copy', time.time() - start))
 
     # new packages
+    start = time.time()
+    cursor.execute(
+        'INSERT INTO sources (name, version, suite, architecture) '
+        'SELECT n.name, n.version, %(suite)s, %(arch)s FROM new_sources AS n '
+        'WHERE NOT EXISTS (SELECT 1 FROM sources AS s WHERE s.name=n.name '
+        'AND s.suite=%(suite)s AND s.architecture=%(arch)s) RETURNING name',
+        {'suite': suite, 'arch': arch})
+    pkgs_to_add = [x[0] for x in cursor.fetchall()]
     if pkgs_to_add:
         log.info('Now inserting %i new sources in the database: %s',
                  len(pkgs_to_add), pkgs_to_add)
-        transaction = conn_db.begin()
-        conn_db.execute(sources_table.insert(), pkgs_to_add)
-        transaction.commit()
+    timings.append(('insert', time.time() - start))
+
+    # updated packages. Only the packages with a different version are
+    # fetched, debian version comparison is not available in SQL.
+    start = time.time()
+    cursor.execute(
+        'SELECT s.id, s.name, s.version, n.version FROM sources AS s '
+        'JOIN new_sources AS n ON n.name=s.name '
+        'WHERE s.suite=%(suite)s AND s.architecture=%(arch)s '
+        'AND s.version != n.version', {'suite': suite, 'arch': arch})
+    different_pkgs = cursor.fetchall()
+    log.debug('Packages different in the archive and in the db: %s',
+              different_pkgs)
+    updated_pkgs = []
+    for pkg_id, name, old_version, version in different_pkgs:
+        if version_compare(version, old_version) > 0:
+            log.debug('New version: ' + str((name, version, suite, arch)) +
+                      ' (we had  ' + old_version + ')')
+            updated_pkgs.append((pkg_id, name))
+    log.info('Pushing ' + str(len(updated_pkgs)) +
+             ' updated packages to the database...')
+    if updated_pkgs:
+        cursor.execute(
+            'UPDATE sources SET version=n.version FROM new_sources AS n '
+            'WHERE n.name=sources.name AND sources.id = ANY(%(ids)s)',
+            {'ids': [x[0] for x in updated_pkgs]})
+    timings.append(('update', time.time() - start))
 
     # RM'ed packages
-    cur_pkgs_name = [x[0] for x in cur_pkgs]
-    new_pkgs_name = [x[0] for x in new_pkgs]
-    rmed_pkgs = [x for x in cur_pkgs_name if x not in new_pkgs_name]
+    start = time.time()
+    cursor.execute(
+        'SELECT s.id, s.name FROM sources AS s '
+        'WHERE s.suite=%(suite)s AND s.architecture=%(arch)s AND NOT EXISTS '
+        '(SELECT 1 FROM new_sources AS n WHERE n.name=s.name)',
+        {'suite': suite, 'arch': arch})
+    rmed = cursor.fetchall()
+    rmed_pkgs = [x[1] for x in rmed]
     log.info('Now deleting %i removed packages: %s', len(rmed_pkgs),
              rmed_pkgs)
-    rmed_pkgs_id = []
-    pkgs_to_rm = []
-    query = "SELECT id FROM sources WHERE name='{}' AND suite='{}' " + \
-            "AND architecture='{}'"
-    for pkg in rmed_pkgs:
-        result = query_db(query.format(pkg, suite, arch))
-        rmed_pkgs_id.append({'deleteid': result[0][0]})
-        pkgs_to_rm.append({'name': pkg, 'suite': suite, 'architecture': arch})
-    log.debug('removed packages ID: %s',
-              [str(x['deleteid']) for x in rmed_pkgs_id])
-    log.debug('removed packages: %s', pkgs_to_rm)
-
-    if rmed_pkgs_id:
-        transaction = conn_db.begin()
-        results_table = db_table('results')
-        schedule_table = db_table('schedule')
-        notes_table = db_table('notes')
-        removed_packages_table = db_table('removed_packages')
-
-        delete_results_query = results_table.delete().\
-            where(results_table.c.package_id == sql.bindparam('deleteid'))
-        delete_schedule_query = schedule_table.delete().\
-            where(schedule_table.c.package_id == sql.bindparam('deleteid'))
-        delete_notes_query = notes_table.delete().\
-            where(notes_table.c.package_id == sql.bindparam('deleteid'))
-        delete_sources_query = sources_table.delete().\
-            where(sources_table.c.id == sql.bindparam('deleteid'))
-
-        conn_db.execute(delete_results_query, rmed_pkgs_id)
-        conn_db.execute(delete_schedule_query, rmed_pkgs_id)
-        conn_db.execute(delete_notes_query, rmed_pkgs_id)
-        conn_db.execute(delete_sources_query, rmed_pkgs_id)
-        conn_db.execute(removed_packages_table.insert(), pkgs_to_rm)
-        transaction.commit()
+    log.debug('removed packages ID: %s', [str(x[0]) for x in rmed])
+    if rmed:
+        ids = {'ids': [x[0] for x in rmed]}
+        cursor.execute('INSERT INTO removed_packages (name, suite, architecture) '
+                       'SELECT name, suite, architecture FROM sources '
+                       'WHERE id = ANY(%(ids)s)', ids)
+        for table in ('results', 'schedule', 'notes'):
+            cursor.execute('DELETE FROM ' + table +
+                           ' WHERE package_id = ANY(%(ids)s)', ids)
+        cursor.execute('DELETE FROM sources WHERE id = ANY(%(ids)s)', ids)
+    timings.append(('delete', time.time() - start))
+
+    start = time.time()
+    transaction.commit()
+    timings.append(('commit', time.time() - start))
+    log.info('Sources of %s/%s synced in %.2fs (%s): %i in the archive, '
+             '%i added, %i updated, %i removed.', suite, arch,
+             sum(x[1] for x in timings),
+             ', '.join('%s %.2fs' % x for x in timings), len(new_pkgs),
+             len(pkgs_to_add), len(updated_pkgs), len(rmed_pkgs))
 
     # finally check whether the db has the correct number of packages
     query = "SELECT count(*) FROM sources WHERE suite='{}' " + \
@@ -396,9 +372,10 @@ def update_sources_db(suite, arch, sources):
         log.critical('source in the reproducible db for the  %s suite: %s',
                      suite, str(pkgs_end[0][0]))
         sys.exit(1)
-    if pkgs_to_add:
-        log.info('Building pages for the new packages')
-        gen_packages_html([Package(x['name']) for x in pkgs_to_add], no_clean=True)
+    # let reproducible_html_packages.py --incremental update the pages
+    journal_packages([(x, suite, arch) for x in pkgs_to_add] +
+                     [(x[1], suite, arch) for x in updated_pkgs] +
+                     [(x, suite, arch) for x in rmed_pkgs])
 
 
 def print_schedule_result(suite, arch, criteria, packages):
@@ -437,267 +414,207 @@ def add_up_numbers(packages, arch):
     return packages_sum
 
 
-def query_untested_packages(suite, arch, limit):
-    criteria = 'not tested before, randomly sorted'
-    query = """SELECT DISTINCT *
-               FROM (
-                    SELECT sources.id, sources.name FROM sources
-                    WHERE sources.suite='{suite}' AND sources.architecture='{arch}'
-                    AND sources.id NOT IN
-                       (SELECT schedule.package_id FROM schedule)
-                    AND sources.id NOT IN
-                       (SELECT results.package_id FROM results)
-                    ORDER BY random()
-                ) AS tmp
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_new_versions(suite, arch, limit):
-    criteria = 'tested before, new version available, sorted by last build date'
-    query = """SELECT s.id, s.name, s.version, r.version, max(r.build_date) max_date
-               FROM sources AS s JOIN results AS r ON s.id = r.package_id
-               WHERE s.suite='{suite}' AND s.architecture='{arch}'
-               AND s.version != r.version
-               AND r.status != 'blacklisted'
-               AND s.id IN (SELECT package_id FROM results)
-               AND s.id NOT IN (SELECT schedule.package_id FROM schedule)
-               GROUP BY s.id, s.name, s.version, r.version
-               ORDER BY max_date
-               LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit)
-    pkgs = query_db(query)
-    # the next line avoids constant rescheduling of packages:
-    # packages in our repository != official repo,
-    # so they will always be selected by the query above
-    # so we only accept them if there version is greater than the already tested one
-    packages = [(x[0], x[1]) for x in pkgs if version_compare(x[2], x[3]) > 0]
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_old_ftbfs_versions(suite, arch, limit):
-    criteria = 'status ftbfs, no bug filed, tested at least 3 days ago, ' + \
-               'no new version available, sorted by last build date'
-    date = (datetime.now()-timedelta(days=3)).strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                JOIN notes AS n ON n.package_id=s.id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status='FTBFS'
-                AND ( n.bugs = '[]' OR n.bugs IS NULL )
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule)
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit,
-                                        date=date)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_old_depwait_versions(suite, arch, limit):
-    criteria = 'status depwait, no bug filed, tested at least 2 days ago, ' + \
-               'no new version available, sorted by last build date'
-    date = (datetime.now()-timedelta(days=2)).strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status='depwait'
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule)
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit,
-                                        date=date)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-
-def query_old_versions(suite, arch, limit):
-    criteria = """tested at least {minimum_age} days ago, no new version available,
-               sorted by last build date""".format(minimum_age=MINIMUM_AGE[arch])
-    date = (datetime.now()-timedelta(days=MINIMUM_AGE[arch]))\
-           .strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status != 'blacklisted'
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule)
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch,
-                                        date=date, limit=limit)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-def query_404_versions(suite, arch, limit):
-    criteria = """tested at least 12h ago, status 404,
+Candidate = namedtuple('Candidate', [
+    'id', 'name', 'suite', 'version', 'tested_version', 'status',
+    'build_date', 'noted', 'bugs', 'scheduled'])
+
+# The categories of packages the planner looks for, in the order they are
+# planned. 'limit' is the LIMITS queue to use (None for LIMIT_404), and
+# 'message' is how they are called in the kgb message.
+CATEGORIES = [
+    {'name': 'untested', 'limit': 'untested', 'what': 'untested packages',
+     'message': ' new packages'},
+    {'name': 'new', 'limit': 'new', 'what': 'new versions',
+     'message': ' new versions'},
+    {'name': 'old_ftbfs', 'limit': 'ftbfs', 'what': 'old ftbfs packages',
+     'message': ' ftbfs without bugs filed'},
+    {'name': 'old_depwait', 'limit': 'depwait',
+     'what': 'old depwait packages', 'message': ' in depwait state'},
+    {'name': '404', 'limit': None, 'what': '404 packages',
+     'message': ' with status \'404\''},
+    {'name': 'old', 'limit': 'old', 'what': 'old packages',
+     'message': ' known versions'},
+]
+
+
+class Planner:
+    """
+    Plan which packages to schedule on an architecture.
+
+    The state of every source of the architecture (its result, whether it
+    has notes and bugs, whether it is already scheduled) is loaded with a
+    single query, then every category and Limit stage is evaluated in memory.
+    A package is planned in one category at most.
+    """
+    def __init__(self, arch):
+        self.arch = arch
+        start = time.time()
+        query = """SELECT s.id, s.name, s.suite, s.version, r.version,
+                          r.status, r.build_date, n.package_id IS NOT NULL,
+                          n.bugs, p.package_id IS NOT NULL
+                   FROM sources AS s
+                   LEFT JOIN results AS r ON r.package_id=s.id
+                   LEFT JOIN notes AS n ON n.package_id=s.id
+                   LEFT JOIN schedule AS p ON p.package_id=s.id
+                   WHERE s.architecture='{arch}'""".format(arch=arch)
+        self.candidates = {suite: [] for suite in SUITES}
+        # packages currently scheduled, per suite
+        self.queued = Counter()
+        for row in query_db(query):
+            pkg = Candidate(*row)
+            pkg = pkg._replace(build_date=pkg.build_date or '')
+            if pkg.scheduled:
+                self.queued[pkg.suite] += 1
+            elif pkg.suite in self.candidates:
+                self.candidates[pkg.suite].append(pkg)
+        self.total = sum(self.queued.values())
+        self.planned = set()
+        self.plan = {}
+        self.timings = {'load': time.time() - start}
+
+    def _tested_before(self, suite, date, status=None):
+        """
+        Packages tested before `date`, with `status` if given, sorted by
+        last build date.
+        """
+        return sorted([x for x in self.candidates[suite]
+                       if x.status is not None and x.build_date < date and
+                       (status is None or x.status == status)],
+                      key=lambda x: x.build_date)
+
+    def untested(self, suite):
+        criteria = 'not tested before, randomly sorted'
+        pkgs = [x for x in self.candidates[suite] if x.status is None]
+        random.shuffle(pkgs)
+        return criteria, pkgs
+
+    def new(self, suite):
+        criteria = 'tested before, new version available, sorted by last build date'
+        # packages in our repository != official repo, so only accept them
+        # if their version is greater than the already tested one, to avoid
+        # constant rescheduling
+        pkgs = [x for x in self.candidates[suite] if x.status is not None and
+                x.status != 'blacklisted' and x.version != x.tested_version and
+                version_compare(x.version, x.tested_version) > 0]
+        return criteria, sorted(pkgs, key=lambda x: x.build_date)
+
+    def old_ftbfs(self, suite):
+        criteria = 'status ftbfs, no bug filed, tested at least 3 days ago, ' + \
+                   'no new version available, sorted by last build date'
+        date = (datetime.now()-timedelta(days=3)).strftime('%Y-%m-%d %H:%M')
+        pkgs = [x for x in self._tested_before(suite, date, 'FTBFS')
+                if x.noted and x.bugs in ('[]', None)]
+        return criteria, pkgs
+
+    def old_depwait(self, suite):
+        criteria = 'status depwait, no bug filed, tested at least 2 days ago, ' + \
+                   'no new version available, sorted by last build date'
+        date = (datetime.now()-timedelta(days=2)).strftime('%Y-%m-%d %H:%M')
+        return criteria, self._tested_before(suite, date, 'depwait')
+
+    def old(self, suite):
+        criteria = """tested at least {minimum_age} days ago, no new version available,
+               sorted by last build date""".format(minimum_age=MINIMUM_AGE[self.arch])
+        date = (datetime.now()-timedelta(days=MINIMUM_AGE[self.arch]))\
+               .strftime('%Y-%m-%d %H:%M')
+        return criteria, [x for x in self._tested_before(suite, date)
+                          if x.status != 'blacklisted']
+
+    def four04(self, suite):
+        criteria = """tested at least 12h ago, status 404,
                sorted by last build date"""
-    date = (datetime.now()-timedelta(days=0.5)).strftime('%Y-%m-%d %H:%M')
-    query = """SELECT s.id, s.name, max(r.build_date) max_date
-                FROM sources AS s JOIN results AS r ON s.id = r.package_id
-                WHERE s.suite='{suite}' AND s.architecture='{arch}'
-                AND r.status = '404'
-                AND r.build_date < '{date}'
-                AND s.id NOT IN (SELECT schedule.package_id FROM schedule)
-                GROUP BY s.id, s.name
-                ORDER BY max_date
-                LIMIT {limit}""".format(suite=suite, arch=arch, limit=limit,
-                                        date=date)
-    packages = query_db(query)
-    print_schedule_result(suite, arch, criteria, packages)
-    return packages
-
-def schedule_untested_packages(arch, total):
-    packages = {}
-    limit = Limit(arch, 'untested')
-    for suite in SUITES:
-        limit.suite = suite
-        many_untested = limit.get_limit('*')
-        log.info('Requesting %s untested packages in %s/%s...',
-                 many_untested, suite, arch)
-        packages[suite] = query_untested_packages(suite, arch, many_untested)
-        log.info('Received ' + str(len(packages[suite])) +
-                 ' untested packages in ' + suite + '/' + arch + ' to schedule.')
-        log.info('--------------------------------------------------------------')
-    msg = add_up_numbers(packages, arch)
-    if msg != '0':
-        msg += ' new packages'
-    else:
-        msg = ''
-    return packages, msg
-
-
-def schedule_new_versions(arch, total):
-    packages = {}
-    limit = Limit(arch, 'new')
-    for suite in SUITES:
-        limit.suite = suite
-        many_new = limit.get_staged_limit(total)
-        log.info('Requesting %s new versions in %s/%s...',
-                 many_new, suite, arch)
-        packages[suite] = query_new_versions(suite, arch, many_new)
-        log.info('Received ' + str(len(packages[suite])) +
-                 ' new packages in ' + suite + '/' + arch + ' to schedule.')
-        log.info('--------------------------------------------------------------')
-    msg = add_up_numbers(packages, arch)
-    if msg != '0':
-        msg += ' new versions'
-    else:
-        msg = ''
-    return packages, msg
-
-
-def schedule_old_ftbfs_versions(arch, total):
-    packages = {}
-    limit = Limit(arch, 'ftbfs')
-    for suite in SUITES:
-        limit.suite = suite
-        old_ftbfs = limit.get_staged_limit(total)
-        log.info('Requesting %s old ftbfs packages in %s/%s...', old_ftbfs,
-                 suite, arch)
-        packages[suite] = query_old_ftbfs_versions(suite, arch, old_ftbfs)
-        log.info('Received ' + str(len(packages[suite])) +
-                 ' old ftbfs packages in ' + suite + '/' + arch + ' to schedule.')
-        log.info('--------------------------------------------------------------')
-    msg = add_up_numbers(packages, arch)
-    if msg != '0':
-        msg += ' ftbfs without bugs filed'
-    else:
-        msg = ''
-    return packages, msg
-
-
-def schedule_old_depwait_versions(arch, total):
-    packages = {}
-    limit = Limit(arch, 'depwait')
-    for suite in SUITES:
-        limit.suite = suite
-        old_depwait = limit.get_staged_limit(total)
-        log.info('Requesting %s old depwait packages in %s/%s...', old_depwait,
-                 suite, arch)
-        packages[suite] = query_old_depwait_versions(suite, arch, old_depwait)
-        log.info('Received ' + str(len(packages[suite])) +
-                 ' old depwait packages in ' + suite + '/' + arch + ' to schedule.')
-        log.info('--------------------------------------------------------------')
-    msg = add_up_numbers(packages, arch)
-    if msg != '0':
-        msg += ' in depwait state'
-    else:
-        msg = ''
-    return packages, msg
-
-
-def schedule_old_versions(arch, total):
-    packages = {}
-    limit = Limit(arch, 'old')
-    for suite in SUITES:
-        limit.suite = suite
-        many_old = limit.get_staged_limit(total)
-        log.info('Requesting %s old packages in %s/%s...', many_old,
-                 suite, arch)
-        packages[suite] = query_old_versions(suite, arch, many_old)
-        log.info('Received ' + str(len(packages[suite])) +
-                 ' old packages in ' + suite + '/' + arch + ' to schedule.')
-        log.info('--------------------------------------------------------------')
-    msg = add_up_numbers(packages, arch)
-    if msg != '0':
-        msg += ' known versions'
-    else:
-        msg = ''
-    return packages, msg
-
-def schedule_404_versions(arch, total):
-    packages = {}
-    for suite in SUITES:
-        log.info('Requesting 404 packages in %s/%s...',
-                 suite, arch)
-        packages[suite] = query_404_versions(suite, arch, LIMIT_404)
-        log.info('Received ' + str(len(packages[suite])) +
-                 ' 404 packages in ' + suite + '/' + arch + ' to schedule.')
-        log.info('--------------------------------------------------------------')
-    msg = add_up_numbers(packages, arch)
-    if msg != '0':
-        msg += ' with status \'404\''
-    else:
-        msg = ''
-    return packages, msg
+        date = (datetime.now()-timedelta(days=0.5)).strftime('%Y-%m-%d %H:%M')
+        return criteria, self._tested_before(suite, date, '404')
+
+    def plan_category(self, category, total):
+        """
+        Plan the packages of `category` in every suite, `total` being the
+        number of packages scheduled and planned so far.
+        Returns the number of planned packages.
+        """
+        start = time.time()
+        name = category['name']
+        select = self.four04 if name == '404' else getattr(self, name)
+        if category['limit']:
+            limit = Limit(self.arch, category['limit'])
+        self.plan[name] = {}
+        for suite in SUITES:
+            if not category['limit']:
+                many = LIMIT_404
+            elif category['limit'] == 'untested':
+                limit.suite = suite
+                many = limit.get_limit('*')
+            else:
+                limit.suite = suite
+                many = limit.get_staged_limit(total)
+            log.info('Requesting %s %s in %s/%s...', many, category['what'],
+                     suite, self.arch)
+            criteria, pkgs = select(suite)
+            packages = [(x.id, x.name) for x in pkgs
+                        if x.id not in self.planned][:many]
+            self.planned.update(x[0] for x in packages)
+            print_schedule_result(suite, self.arch, criteria, packages)
+            self.plan[name][suite] = packages
+            log.info('Received ' + str(len(packages)) + ' ' +
+                     category['what'] + ' in ' + suite + '/' + self.arch +
+                     ' to schedule.')
+            log.info('--------------------------------------------------------------')
+        self.timings[name] = time.time() - start
+        return sum(len(x) for x in self.plan[name].values())
+
+    def make_plan(self):
+        log.info('==============================================================')
+        log.info('Currently scheduled packages in all suites on ' + self.arch +
+                 ': ' + str(self.total))
+        total = self.total
+        if total > MAXIMA[self.arch]:
+            log.info(str(total) + ' packages already scheduled' +
+                     ', only scheduling new versions.')
+        else:
+            log.info(str(total) + ' packages already scheduled' +
+                     ', scheduling some more...')
+        for category in CATEGORIES:
+            if total > MAXIMA[self.arch] and category['name'] != 'new':
+                self.plan[category['name']] = {suite: [] for suite in SUITES}
+                continue
+            total += self.plan_category(category, total)
+        return self.plan
+
+    def message(self, category):
+        packages = self.plan[category['name']]
+        msg = add_up_numbers(packages, self.arch)
+        if msg != '0':
+            return msg + category['message']
+        return ''
+
+    def print_plan(self):
+        print('Plan for {}, {} packages currently scheduled '
+              '(loaded in {:.2f}s):'.format(self.arch, self.total,
+                                           self.timings['load']))
+        for category in CATEGORIES:
+            name = category['name']
+            counts = [len(self.plan[name][suite]) for suite in SUITES]
+            print('  {:12} {:5} ({}){}'.format(
+                name, sum(counts), '+'.join(str(x) for x in counts),
+                ' in {:.2f}s'.format(self.timings[name])
+                if name in self.timings else ''))
+            for suite in SUITES:
+                if self.plan[name][suite]:
+                    print('    {}: {}'.format(suite, ' '.join(
+                        x[1] for x in self.plan[name][suite])))
 
 
 def scheduler(arch):
-    query = "SELECT count(*) " + \
-            "FROM schedule AS p JOIN sources AS s ON p.package_id=s.id " + \
-            "WHERE s.architecture='{arch}'"
-    total = int(query_db(query.format(arch=arch))[0][0])
-    log.info('==============================================================')
-    log.info('Currently scheduled packages in all suites on ' + arch + ': ' + str(total))
-    if total > MAXIMA[arch]:
-        log.info(str(total) + ' packages already scheduled' +
-                 ', only scheduling new versions.')
-        empty_pkgs = {}
-        for suite in SUITES:
-            empty_pkgs[suite] = []
-        untested, msg_untested = empty_pkgs, ''
-        new, msg_new = schedule_new_versions(arch, total)
-        old_ftbfs, msg_old_ftbfs = empty_pkgs, ''
-        old_depwait, msg_old_depwait = empty_pkgs, ''
-        old, msg_old = empty_pkgs, ''
-        four04, msg_404 = empty_pkgs, ''
-    else:
-        log.info(str(total) + ' packages already scheduled' +
-                 ', scheduling some more...')
-        untested, msg_untested = schedule_untested_packages(arch, total)
-        new, msg_new = schedule_new_versions(arch, total+len(untested))
-        old_ftbfs, msg_old_ftbfs = schedule_old_ftbfs_versions(arch, total+len(untested)+len(new))
-        old_depwait, msg_old_depwait = schedule_old_depwait_versions(arch, total+len(untested)+len(new)+len(old_ftbfs))
-        four04, msg_404 = schedule_404_versions(arch, total+len(untested)+len(new)+len(old_ftbfs)+len(old_depwait))
-        old, msg_old = schedule_old_versions(arch, total+len(untested)+len(new)+len(old_ftbfs)+len(old_depwait)+len(four04))
+    planner = Planner(arch)
+    plan = planner.make_plan()
+    untested = plan['untested']
+    new = plan['new']
+    old_ftbfs = plan['old_ftbfs']
+    old_depwait = plan['old_depwait']
+    four04 = plan['404']
+    old = plan['old']
+    msg_untested, msg_new, msg_old_ftbfs, msg_old_depwait, msg_404, msg_old = \
+        [planner.message(x) for x in CATEGORIES]
 
     now_queued_here = {}
     # make sure to schedule packages in unstable first
@@ -707,11 +624,7 @@ def scheduler(arch):
         if suite not in priotized_suite_order:
             priotized_suite_order.append(suite)
     for suite in priotized_suite_order:
-        query = "SELECT count(*) " \
-                "FROM schedule AS p JOIN sources AS s ON p.package_id=s.id " \
-                "WHERE s.suite='{suite}' AND s.architecture='{arch}'"
-        query = query.format(suite=suite, arch=arch)
-        now_queued_here[suite] = int(query_db(query)[0][0]) + \
+        now_queued_here[suite] = planner.queued[suite] + \
             len(untested[suite]+new[suite]+old[suite])
         # schedule packages differently in the queue...
         to_be_scheduled = queue_packages({}, untested[suite], datetime.now()+timedelta(minutes=-720))
@@ -750,7 +663,33 @@ def scheduler(arch):
             return message + '\n'
     return ''
 
+def print_plans():
+    """
+    Print what would be scheduled on every architecture, without touching
+    the database.
+    """
+    start = time.time()
+    for arch in ARCHS:
+        planner = Planner(arch)
+        if planner.total > (MAXIMA[arch]*3):
+            print('{} packages already scheduled for {}, nothing to do.'.format(
+                planner.total, arch))
+            continue
+        planner.make_plan()
+        planner.print_plan()
+    print('Planned all architectures in {:.2f}s.'.format(time.time() - start))
+
+
 if __name__ == '__main__':
+    local_parser = argparse.ArgumentParser(
+        description='Update the sources tables and schedule packages')
+    local_parser.add_argument('--plan-only', action='store_true',
+        help='only print what would be scheduled, without updating the '
+             'sources tables nor scheduling anything')
+    local_args = local_parser.parse_known_args(unknown_args)[0]
+    if local_args.plan_only:
+        print_plans()
+        sys.exit(0)
     log.info('Updating sources tables for all suites.')
     for suite in SUITES:
         update_sources(suite)
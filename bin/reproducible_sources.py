@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Licensed under GPL-2
+#
+# Depends: python3
+#
+# Shared, locally cached, copy of the Sources files of the tested suites.
+#
+# For every suite the cache directory holds:
+#  * Sources: the decompressed Sources file, as needed by eg. dd-list(1)
+#  * sources.tsv: a compact "name version extra-source-only" table
+#  * checksum: the SHA256 of Sources.xz as listed in the Release file
+# Both the files are only refreshed when the checksum in the Release file
+# changes, and Sources.xz is decompressed and parsed in a single streaming
+# pass while downloading it.
+
+import os
+import lzma
+import hashlib
+from collections import namedtuple
+from urllib.request import urlopen
+
+from reproducible_common import *
+
+
+Source = namedtuple('Source', ['name', 'version', 'extra_source_only'])
+
+SOURCES_XZ = 'main/source/Sources.xz'
+
+_sources = {}
+
+
+class _HashingReader:
+    """
+    Wrap a file object, computing the SHA256 of what is read through it.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+
+def _open(mirror, path):
+    if os.path.isdir(mirror):
+        return open(os.path.join(mirror, path), 'rb')
+    return urlopen(mirror + '/' + path)
+
+
+def _cache_dir(suite):
+    return os.path.join(SOURCES_CACHE_PATH, suite)
+
+
+def get_release_checksum(suite, mirror=None):
+    """
+    Return the SHA256 of main/source/Sources.xz listed in the InRelease (or
+    Release) file of `suite`, or None if it can't be found.
+    """
+    mirror = mirror or args.mirror
+    for release in ('InRelease', 'Release'):
+        try:
+            with _open(mirror, 'dists/' + suite + '/' + release) as fd:
+                content = fd.read().decode('utf-8')
+        except OSError as e:
+            log.debug('Could not get %s for %s: %s', release, suite, e)
+            continue
+        in_sha256 = False
+        for line in content.splitlines():
+            if not line.startswith(' '):
+                in_sha256 = line.strip() == 'SHA256:'
+                continue
+            if in_sha256:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == SOURCES_XZ:
+                    return fields[0]
+    log.warning('Could not find the checksum of the %s Sources.xz', suite)
+    return None
+
+
+def _read_table(suite):
+    with open(os.path.join(_cache_dir(suite), 'sources.tsv')) as fd:
+        return [Source(name, version, eso == 'yes') for name, version, eso
+                in (line.rstrip('\n').split('\t') for line in fd)]
+
+
+def _write_file(suite, filename, lines):
+    with NamedTemporaryFile(mode='w', dir=_cache_dir(suite),
+                            delete=False) as fd:
+        fd.writelines(lines)
+    os.rename(fd.name, os.path.join(_cache_dir(suite), filename))
+
+
+def _download(suite, mirror):
+    """
+    Stream-decompress Sources.xz, saving it decompressed and parsing every
+    paragraph into a Source at the same time.
+    Returns the list of sources and the SHA256 of the downloaded Sources.xz.
+    """
+    remotefile = mirror + '/dists/' + suite + '/' + SOURCES_XZ
+    log.info('Downloading sources file for %s: %s', suite, remotefile)
+    sources = []
+    fields = {}
+    with _open(mirror, 'dists/' + suite + '/' + SOURCES_XZ) as remote, \
+            NamedTemporaryFile(mode='w', dir=_cache_dir(suite),
+                               delete=False) as decompressed:
+        reader = _HashingReader(remote)
+        with lzma.open(reader, 'rt', encoding='utf-8') as xz:
+            for line in xz:
+                decompressed.write(line)
+                if line[0] in (' ', '\t'):  # continuation line
+                    continue
+                if line == '\n':  # end of a paragraph
+                    if fields:
+                        sources.append(Source(
+                            fields['Package'], fields['Version'],
+                            fields.get('Extra-Source-Only') == 'yes'))
+                    fields = {}
+                    continue
+                key, _, value = line.partition(':')
+                if key in ('Package', 'Version', 'Extra-Source-Only'):
+                    fields[key] = value.strip()
+            if fields:
+                sources.append(Source(
+                    fields['Package'], fields['Version'],
+                    fields.get('Extra-Source-Only') == 'yes'))
+    os.rename(decompressed.name, sources_file(suite))
+    log.debug('\tdownloaded and parsed %s sources', len(sources))
+    return sources, reader.sha256.hexdigest()
+
+
+def get_sources(suite, mirror=None):
+    """
+    Return the list of Source of `suite`, reusing the local copy if the
+    Release file of the mirror still lists the same Sources.xz.
+    `mirror` defaults to --mirror, and can either be an URL or a local
+    directory.
+    """
+    if suite in _sources:
+        return _sources[suite]
+    mirror = mirror or args.mirror
+    os.makedirs(_cache_dir(suite), exist_ok=True)
+    checksum = get_release_checksum(suite, mirror)
+    checksum_file = os.path.join(_cache_dir(suite), 'checksum')
+    try:
+        with open(checksum_file) as fd:
+            cached_checksum = fd.read().strip()
+    except OSError:
+        cached_checksum = None
+    if checksum and checksum == cached_checksum:
+        try:
+            _sources[suite] = _read_table(suite)
+            log.info('Sources.xz of %s unchanged, using the cached copy.',
+                     suite)
+            return _sources[suite]
+        except (OSError, ValueError) as e:
+            log.warning('Could not read the cached sources of %s: %s',
+                        suite, e)
+    sources, sha256 = _download(suite, mirror)
+    _write_file(suite, 'sources.tsv', ('{}\t{}\t{}\n'.format(
+        x.name, x.version, 'yes' if x.extra_source_only else 'no')
+        for x in sources))
+    if checksum and sha256 != checksum:
+        # probably the mirror was being updated, try again the next time
+        log.warning('The checksum of the %s Sources.xz does not match the '
+                    'one in the Release file, not caching it.', suite)
+        sha256 = ''
+    _write_file(suite, 'checksum', [sha256 + '\n'])
+    _sources[suite] = sources
+    return sources
+
+
+def sources_file(suite):
+    """
+    Return the path of the decompressed Sources file of `suite`.
+    Call get_sources() first to be sure it's up to date.
+    """
+    return os.path.join(_cache_dir(suite), 'Sources')
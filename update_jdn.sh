@@ -454,6 +454,8 @@ if [ -f /etc/debian_version ] ; then
 				poxml 
 				procmail 
 				python3-debian 
+				python3-matplotlib
+				python3-numpy
 				python3-pystache
 				python3-sqlalchemy
 				python3-xdg
@@ -463,7 +465,6 @@ if [ -f /etc/debian_version ] ; then
 				python-imaging 
 				python-lzma 
 				python-pip 
-				python-rpy2 
 				python-setuptools 
 				python-twisted 
 				python-yaml 